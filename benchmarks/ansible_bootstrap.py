@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Bootstrap benchmark of ansible-runner, ansible-cli and ansible-runner-inventory: how long sourcing
+# ansible-common.sh takes with the Cycloid credentials of every cloud, extra vars, tags and ssh keys set. It is paid
+# before any play runs, by each of those scripts.
+#
+# Each run is a new bash, the median of the runs is reported and compared to the last entry of
+# ansible_bootstrap.json. It writes the inventories and the ssh keys, so run it in the toolkit image:
+#   docker run --rm -v "$PWD:/src" -w /src cycloid/cycloid-toolkit:develop python benchmarks/ansible_bootstrap.py
+# and record the result of a release with --save <release>. --common times another ansible-common.sh, like the one
+# of a previous release from `git show <release>:scripts/ansible-common.sh`.
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts")
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ansible_bootstrap.json")
+# Source the script like ansible-runner does, wait for its background phases, and stop the ssh agent it starts. The
+# trap is replaced by the one of ansible-common.sh removing its phases, the agent is stopped once they are over
+SOURCE = ('trap "ssh-agent -k >/dev/null 2>&1" EXIT; source "$1" >/dev/null 2>&1; '
+          '! declare -F phases_wait >/dev/null || phases_wait >/dev/null 2>&1; ssh-agent -k >/dev/null 2>&1')
+
+
+def make_keys(path, count):
+    """ SSH_PRIVATE_KEYS as set by Cycloid, a JSON list of private keys """
+    keys = []
+    for index in range(count):
+        key = os.path.join(path, "id_%d" % index)
+        subprocess.run(["ssh-keygen", "-q", "-t", "ed25519", "-N", "", "-f", key], check=True)
+        with open(key) as f:
+            keys.append(f.read())
+    return json.dumps(keys)
+
+
+def make_env(keys):
+    env = dict((key, value) for key, value in os.environ.items() if not key.startswith(("ANSIBLE_", "AWS_", "AZURE_")))
+    env.update(
+        # The scripts of the checkout first, for ansible-common.sh to find them
+        PATH=SCRIPTS + os.pathsep + os.environ["PATH"],
+        CY_AWS_CRED=json.dumps(dict(access_key="AKIAEXAMPLE", secret_key="secret")),
+        CY_AZURE_CRED=json.dumps(dict(client_id="client", client_secret="secret", subscription_id="subscription",
+                                      tenant_id="tenant")),
+        CY_GCP_CRED=json.dumps(dict(json_key=dict(type="service_account", project_id="project",
+                                                  client_email="bench@project.iam.gserviceaccount.com"))),
+        CY_VMWARE_CRED=json.dumps(dict(username="user", password="password")),
+        VMWARE_SERVER="vcenter.example.com",
+        ANSIBLE_EXTRA_VARS=json.dumps(dict(env="bench", project="toolkit", customer="cycloid", replicas=3)),
+        TAGS=json.dumps(["deploy", "config"]),
+        SKIP_TAGS=json.dumps(["debug"]),
+        SSH_PRIVATE_KEYS=keys,
+    )
+    return env
+
+
+def timed(common, env, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.run(["bash", "-c", SOURCE, "bash", common], env=env)
+        times.append(time.perf_counter() - start)
+        if process.returncode != 0:
+            sys.exit("Sourcing %s exited with %d" % (common, process.returncode))
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--common", default=os.path.join(SCRIPTS, "ansible-common.sh"))
+    parser.add_argument("--keys", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--save", metavar="RELEASE", help="Record the results in ansible_bootstrap.json")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        env = make_env(make_keys(path, args.keys))
+        results = dict(bootstrap=timed(os.path.abspath(args.common), env, args.repeat))
+
+    with open(BASELINE) as f:
+        baseline = json.load(f)
+    previous = baseline[-1] if baseline else None
+
+    print("ansible-common.sh bootstrap, %d ssh keys, median of %d runs" % (args.keys, args.repeat))
+    for name, elapsed in sorted(results.items()):
+        line = "%-15s %8.3fs" % (name, elapsed)
+        if previous:
+            line += "  %+6.0f%% vs %s" % ((elapsed / previous[name] - 1) * 100, previous["release"])
+        print(line)
+
+    if args.save:
+        baseline.append(dict(release=args.save, keys=args.keys,
+                             **dict((name, round(elapsed, 3)) for name, elapsed in results.items())))
+        with open(BASELINE, "w") as f:
+            json.dump(baseline, f, indent=2)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
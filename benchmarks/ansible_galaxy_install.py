@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Offline benchmark of ansible-galaxy-install: a requirements file of N roles is installed from a local HTTP server
+# serving role tarballs, in place of Ansible Galaxy and GitHub, with a latency added to every download. It reports
+# the wall time for each number of ANSIBLE_GALAXY_WORKERS, and the speedup over installing them in a row:
+#   python benchmarks/ansible_galaxy_install.py --roles 30 --workers 1,4,8 --latency 0.5
+# --save records the results in ansible_galaxy_install.json.
+
+import argparse
+import http.server
+import io
+import json
+import os
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+
+INSTALL = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts", "ansible-galaxy-install")
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ansible_galaxy_install.json")
+META = """galaxy_info:
+  author: benchmark
+  description: Role %d of the benchmark
+  license: MIT
+  min_ansible_version: "2.9"
+  platforms: []
+dependencies: []
+"""
+
+
+def role_tarball(index):
+    """ A role as downloaded from GitHub, a tarball with the role in a top directory """
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w:gz") as tar:
+        for name, content in (("meta/main.yml", META % index), ("tasks/main.yml", "- debug: msg=role_%d\n" % index)):
+            content = content.encode("utf-8")
+            info = tarfile.TarInfo("role_%d-main/%s" % (index, name))
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return data.getvalue()
+
+
+def serve(tarballs, latency):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency)
+            body = tarballs.get(self.path.lstrip("/"))
+            if body is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/gzip")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def timed(requirements, workers):
+    with tempfile.TemporaryDirectory() as playbook:
+        env = dict(os.environ, ANSIBLE_GALAXY_WORKERS=str(workers))
+        env.pop("ANSIBLE_GALAXY_CACHE_DIR", None)
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, INSTALL, requirements], cwd=playbook, env=env,
+                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        elapsed = time.perf_counter() - start
+        if process.returncode != 0:
+            sys.exit("ansible-galaxy-install exited with %d:\n%s" % (process.returncode, process.stdout))
+        installed = len(os.listdir(os.path.join(playbook, "roles")))
+    return elapsed, installed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--roles", type=int, default=30)
+    parser.add_argument("--workers", default="1,4,8", help="Comma separated numbers of workers, 1 installs in a row")
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds added to every download")
+    parser.add_argument("--save", metavar="RELEASE", help="Record the results in ansible_galaxy_install.json")
+    args = parser.parse_args()
+
+    tarballs = dict(("role_%d.tar.gz" % index, role_tarball(index)) for index in range(args.roles))
+    server = serve(tarballs, args.latency)
+    with tempfile.TemporaryDirectory() as path:
+        requirements = os.path.join(path, "requirements.yml")
+        with open(requirements, "w") as f:
+            for index in range(args.roles):
+                f.write("- src: http://127.0.0.1:%d/role_%d.tar.gz\n  name: role_%d\n"
+                        % (server.server_address[1], index, index))
+        results = dict()
+        for workers in [int(workers) for workers in args.workers.split(",")]:
+            elapsed, installed = timed(requirements, workers)
+            if installed != args.roles:
+                sys.exit("%d roles installed with %d workers, expected %d" % (installed, workers, args.roles))
+            results[workers] = elapsed
+    server.shutdown()
+
+    print("ansible-galaxy-install, %d roles, %.2fs download latency" % (args.roles, args.latency))
+    serial = results.get(1)
+    for workers, elapsed in sorted(results.items()):
+        line = "%2d workers %8.3fs" % (workers, elapsed)
+        if serial:
+            line += "  x%.1f" % (serial / elapsed)
+        print(line)
+
+    if args.save:
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+        baseline.append(dict(release=args.save, roles=args.roles, latency=args.latency,
+                             workers=dict((str(workers), round(elapsed, 3)) for workers, elapsed in results.items())))
+        with open(BASELINE, "w") as f:
+            json.dump(baseline, f, indent=2)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
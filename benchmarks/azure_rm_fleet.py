@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Offline benchmark of the azure_rm.py inventory script against synthetic fleets: the compute, network and
+# resource clients of AzureRM are replaced by the in-process fakes of tests/azure-rm/fake_arm.py, answering for N
+# virtual machines, with their network interfaces, public IPs, security groups and tags, and an optional latency
+# injected in every call.
+#
+# For each fleet size it reports the wall time of AzureInventory.get_inventory, the API calls made by
+# operation and the peak memory traced while it runs (in a second pass, as tracing slows everything down).
+# Results are compared to azure_rm_fleet.json when it was saved with the same options:
+#   python benchmarks/azure_rm_fleet.py --sizes 100,1000 -- --prefetch-network
+# Arguments after -- are given to azure_rm.py. --save records the results as the new baseline, and
+# --max-regression fails when a run makes more calls, or is slower or larger by more than that percentage.
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from azure_rm_groups import load_azure_rm
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests", "azure-rm"))
+import fake_arm  # noqa: E402
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "azure_rm_fleet.json")
+SUBSCRIPTION_ID = "00000000-0000-0000-0000-000000000000"
+PAGE_SIZE = 1000
+
+
+class SyntheticFleet(fake_arm.Fleet):
+    """ size virtual machines of one subscription, spread over resource groups, with the network interfaces, public
+        IPs, security groups and tags set by the options """
+
+    def __init__(self, size, options):
+        super(SyntheticFleet, self).__init__(
+            subscription_ids=(SUBSCRIPTION_ID,), latency=options.latency, page_size=PAGE_SIZE
+        )
+        for index in range(size):
+            resource_group = "rg-%d" % (index % options.resource_groups)
+            providers = "/subscriptions/%s/resourceGroups/%s/providers/" % (SUBSCRIPTION_ID, resource_group)
+            security_group = self._security_group(
+                providers, (index // options.resource_groups) % options.security_groups
+            )
+            interfaces = []
+            for nic in range(options.interfaces):
+                interface = self._interface(providers, index, nic, options)
+                security_group.network_interfaces.append(SimpleNamespace(id=interface.id))
+                interfaces.append(SimpleNamespace(id=interface.id))
+            machine = self._machine(providers, index, interfaces, options)
+            self.machines[machine.id.lower()] = machine
+
+    def _security_group(self, providers, index):
+        security_group_id = providers + "Microsoft.Network/networkSecurityGroups/nsg-%d" % index
+        if security_group_id.lower() not in self.security_groups:
+            self.security_groups[security_group_id.lower()] = SimpleNamespace(
+                id=security_group_id, name="nsg-%d" % index, network_interfaces=[]
+            )
+        return self.security_groups[security_group_id.lower()]
+
+    def _interface(self, providers, index, nic, options):
+        public_ip = None
+        if nic == 0 and index % 100 < options.public_ips * 100:
+            public_ip = SimpleNamespace(
+                id=providers + "Microsoft.Network/publicIPAddresses/vm-%d-ip" % index,
+                name="vm-%d-ip" % index,
+                ip_address="20.%d.%d.%d" % (index // 65536, index // 256 % 256, index % 256),
+                public_ip_allocation_method="Static",
+                dns_settings=SimpleNamespace(fqdn="vm-%d.westeurope.cloudapp.azure.com" % index) if index % 2 else None,
+            )
+            self.addresses[public_ip.id.lower()] = public_ip
+        interface = SimpleNamespace(
+            id=providers + "Microsoft.Network/networkInterfaces/vm-%d-nic-%d" % (index, nic),
+            name="vm-%d-nic-%d" % (index, nic),
+            primary=nic == 0,
+            mac_address="00-0D-3A-%02X-%02X-%02X" % (index // 65536, index // 256 % 256, index % 256),
+            ip_configurations=[
+                SimpleNamespace(
+                    private_ip_address="10.%d.%d.%d" % (nic, index // 256 % 256, index % 256),
+                    private_ip_allocation_method="Dynamic",
+                    public_ip_address=SimpleNamespace(id=public_ip.id) if public_ip else None,
+                )
+            ],
+        )
+        self.interfaces[interface.id.lower()] = interface
+        return interface
+
+    def _machine(self, providers, index, interfaces, options):
+        windows = index % 10 == 0
+        windows_configuration = None
+        if windows:
+            windows_configuration = SimpleNamespace(
+                enable_automatic_updates=True,
+                time_zone="UTC",
+                win_rm=SimpleNamespace(listeners=[SimpleNamespace(protocol=SimpleNamespace(name="Http"),
+                                                                  certificate_url=None)]),
+            )
+        return SimpleNamespace(
+            id=providers + "Microsoft.Compute/virtualMachines/vm-%d" % index,
+            name="vm-%d" % index,
+            type="Microsoft.Compute/virtualMachines",
+            location=("westeurope", "northeurope", "eastus")[index % 3],
+            tags=dict(("tag-%d" % tag, "value-%d" % ((index + tag) % options.tag_values)) for tag in range(options.tags))
+            or None,
+            plan=None,
+            hardware_profile=SimpleNamespace(vm_size=("Standard_B2s", "Standard_D4s_v3")[index % 2]),
+            provisioning_state="Succeeded",
+            os_profile=SimpleNamespace(computer_name="vm-%d" % index, windows_configuration=windows_configuration),
+            storage_profile=SimpleNamespace(
+                os_disk=SimpleNamespace(name="vm-%d-disk" % index,
+                                        os_type=SimpleNamespace(value="Windows" if windows else "Linux")),
+                image_reference=SimpleNamespace(offer="debian-12", publisher="Debian", sku="12", version="latest"),
+            ),
+            network_profile=SimpleNamespace(network_interfaces=interfaces),
+            instance_view=SimpleNamespace(statuses=[
+                SimpleNamespace(code="ProvisioningState/succeeded"),
+                SimpleNamespace(code="PowerState/deallocated" if index % 7 == 0 else "PowerState/running"),
+            ]),
+        )
+
+
+class NullWriter(object):
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+def run(azure_rm, fleet, argv, trace):
+    """ Build the inventory of fleet, returns the time get_inventory took and the peak memory traced meanwhile """
+    measures = dict()
+
+    class Inventory(azure_rm.AzureInventory):
+        def get_inventory(self):
+            if trace:
+                tracemalloc.start()
+            start = time.perf_counter()
+            super(Inventory, self).get_inventory()
+            measures["seconds"] = time.perf_counter() - start
+            if trace:
+                measures["peak_mb"] = tracemalloc.get_traced_memory()[1] / 1024.0 / 1024.0
+                tracemalloc.stop()
+
+    azure_rm.AzureRM = fake_arm.fake_azure_rm(azure_rm, fleet)
+    azure_rm.load_azure_sdk = lambda: True
+    sys.argv = ["azure_rm.py", "--list"] + argv
+    with contextlib.redirect_stdout(NullWriter()), contextlib.redirect_stderr(NullWriter()):
+        try:
+            Inventory()
+        except SystemExit as exc:
+            if exc.code not in (0, None):
+                raise
+    return measures
+
+
+def compare(result, previous, max_regression):
+    """ Describe the changes from previous, and whether they exceed max_regression """
+    changes = []
+    regressed = False
+    for name in ("seconds", "peak_mb"):
+        change = (result[name] / previous[name] - 1) * 100 if previous[name] else 0
+        changes.append("%+.0f%% %s" % (change, name))
+        regressed = regressed or (max_regression is not None and change > max_regression)
+    calls = sum(result["calls"].values()) - sum(previous["calls"].values())
+    if calls:
+        changes.append("%+d calls" % calls)
+    regressed = regressed or (max_regression is not None and calls > 0)
+    return ", ".join(changes), regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(usage="%(prog)s [options] [-- azure_rm.py arguments]")
+    parser.add_argument("--sizes", default="100,1000,10000,50000", help="Comma separated numbers of machines")
+    parser.add_argument("--resource-groups", type=int, default=20)
+    parser.add_argument("--interfaces", type=int, default=1, help="Network interfaces per machine")
+    parser.add_argument("--public-ips", type=float, default=0.5, help="Share of the machines with a public IP")
+    parser.add_argument("--security-groups", type=int, default=2, help="Security groups per resource group")
+    parser.add_argument("--tags", type=int, default=5, help="Tags per machine")
+    parser.add_argument("--tag-values", type=int, default=10, help="Distinct values of each tag")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every API call")
+    parser.add_argument("--save", action="store_true", help="Record the results in azure_rm_fleet.json")
+    parser.add_argument("--max-regression", type=float, metavar="PERCENT",
+                        help="Exit with an error when a run is slower or larger than the baseline by more than "
+                             "PERCENT, or makes more API calls")
+    parser.add_argument("azure_rm_args", nargs="*", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    options = dict((key, value) for key, value in vars(args).items()
+                   if key not in ("sizes", "save", "max_regression"))
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    baseline = dict(options=None, results=dict())
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+    if baseline["options"] != options:
+        baseline = dict(options=None, results=dict())
+
+    azure_rm = load_azure_rm()
+    # Settings come from the environment when there is no azure_rm.ini, keep them out of the runs
+    for key in [key for key in os.environ if key.startswith("AZURE_")]:
+        del os.environ[key]
+
+    results = dict()
+    failed = False
+    print("azure_rm fleet benchmark, azure_rm.py --list %s" % " ".join(args.azure_rm_args))
+    print("%8s %10s %8s %10s" % ("machines", "seconds", "calls", "peak MB"))
+    for size in sizes:
+        fleet = SyntheticFleet(size, args)
+        result = run(azure_rm, fleet, args.azure_rm_args, trace=False)
+        result["calls"] = dict(fleet.calls)
+        result["peak_mb"] = run(azure_rm, SyntheticFleet(size, args), args.azure_rm_args, trace=True)["peak_mb"]
+        results[str(size)] = dict(result, seconds=round(result["seconds"], 4), peak_mb=round(result["peak_mb"], 2))
+
+        line = "%8d %10.3f %8d %10.1f" % (size, result["seconds"], sum(result["calls"].values()), result["peak_mb"])
+        previous = baseline["results"].get(str(size))
+        if previous:
+            changes, regressed = compare(result, previous, args.max_regression)
+            line += "  " + changes
+            failed = failed or regressed
+        print(line)
+
+    if args.save:
+        with open(BASELINE, "w") as f:
+            json.dump(dict(options=options, results=results), f, indent=2, sort_keys=True)
+            f.write("\n")
+    if failed:
+        sys.exit("azure_rm fleet benchmark regressed by more than %g%% of the baseline" % args.max_regression)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Micro-benchmark of the azure_rm.py inventory script grouping: how many hosts per second
+# AzureInventory._add_host groups by OS family, resource group, location and tags.
+#
+# The list based grouping azure_rm.py used before is timed on the same hosts for comparison.
+# Run it in the toolkit image:
+#   docker run --rm -v "$PWD:/src" -w /src cycloid/cycloid-toolkit:develop python benchmarks/azure_rm_groups.py
+
+import argparse
+import importlib.util
+import os
+import re
+import time
+
+AZURE_RM = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "files", "ansible", "etc", "hosts-template", "azure_rm.py"
+)
+
+
+def load_azure_rm():
+    spec = importlib.util.spec_from_file_location("azure_rm", AZURE_RM)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_hosts(count, tags):
+    hosts = []
+    for index in range(count):
+        hosts.append(
+            dict(
+                name="vm-%d.example" % index,
+                id="/subscriptions/sub/resourceGroups/rg-%d/providers/Microsoft.Compute/virtualMachines/vm-%d"
+                % (index % 40, index),
+                resource_group="rg-%d" % (index % 40),
+                location=("westeurope", "northeurope", "eastus")[index % 3],
+                os_disk=dict(name="disk-%d" % index, operating_system_type=("linux", "windows")[index % 7 == 0]),
+                security_group="nsg-%d" % (index % 40),
+                # Most tags take a few values, the last one is unique to each host
+                tags=dict(
+                    ("tag:%d" % tag, "value %d" % (index % (tag + 2)) if tag < tags - 1 else "host %d" % index)
+                    for tag in range(tags)
+                ),
+            )
+        )
+    return hosts
+
+
+class LegacyGroups(object):
+    """ The grouping of azure_rm.py before group names were memoized and groups became ordered sets """
+
+    def __init__(self):
+        self.replace_dash_in_groups = False
+        self._inventory = dict(_meta=dict(hostvars=dict()), azure=[])
+
+    def _to_safe(self, word):
+        regex = r"[^A-Za-z0-9\_"
+        if not self.replace_dash_in_groups:
+            regex += r"\-"
+        return re.sub(regex + "]", "_", word)
+
+    def _add_host(self, vars):
+        host_name = self._to_safe(vars["name"])
+        resource_group = self._to_safe(vars["resource_group"])
+        operating_system_type = self._to_safe(vars["os_disk"]["operating_system_type"].lower())
+        security_group = self._to_safe(vars["security_group"])
+        for group in (operating_system_type, resource_group, vars["location"], security_group):
+            if not self._inventory.get(group):
+                self._inventory[group] = []
+            self._inventory[group].append(host_name)
+        self._inventory["_meta"]["hostvars"][host_name] = vars
+        self._inventory["azure"].append(host_name)
+        for key, value in vars["tags"].items():
+            safe_key = self._to_safe(key)
+            safe_value = safe_key + "_" + self._to_safe(value)
+            if not self._inventory.get(safe_key):
+                self._inventory[safe_key] = []
+            if not self._inventory.get(safe_value):
+                self._inventory[safe_value] = []
+            self._inventory[safe_key].append(host_name)
+            self._inventory[safe_value].append(host_name)
+
+
+def new_inventory(azure_rm):
+    inventory = azure_rm.AzureInventory.__new__(azure_rm.AzureInventory)
+    inventory.replace_dash_in_groups = False
+    inventory.group_by_resource_group = True
+    inventory.group_by_location = True
+    inventory.group_by_os_family = True
+    inventory.group_by_security_group = True
+    inventory.group_by_tag = True
+    inventory._reset_inventory()
+    return inventory
+
+
+def timed(new, hosts, repeat):
+    best = None
+    for _ in range(repeat):
+        inventory = new()
+        start = time.perf_counter()
+        for vars in hosts:
+            inventory._add_host(vars)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(inventory._inventory) - 1
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hosts", type=int, default=50000)
+    parser.add_argument("--tags", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    azure_rm = load_azure_rm()
+    hosts = make_hosts(args.hosts, args.tags)
+
+    print("azure_rm grouping, %d hosts with %d tags each, best of %d" % (args.hosts, args.tags, args.repeat))
+    results = [
+        ("legacy", timed(LegacyGroups, hosts, args.repeat)),
+        ("current", timed(lambda: new_inventory(azure_rm), hosts, args.repeat)),
+    ]
+    for name, (elapsed, groups) in results:
+        print("%-8s %8.3fs %10.0f hosts/s %8d groups" % (name, elapsed, args.hosts / elapsed, groups))
+    print("speedup  %8.2fx" % (results[0][1][0] / results[1][1][0]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Startup benchmark of the azure_rm.py inventory script: how long `azure_rm.py --list` takes to answer from a
+# fresh inventory cache, and to reject a bad argument. Both are paid by every ansible-playbook run using the
+# script as inventory source, and neither needs the Azure SDK.
+#
+# Each case is run in a new interpreter, the median of the runs is reported and compared to the last entry of
+# azure_rm_startup.json. Run it in the toolkit image, where the Azure SDK and ansible are installed:
+#   docker run --rm -v "$PWD:/src" -w /src cycloid/cycloid-toolkit:develop python benchmarks/azure_rm_startup.py
+# and record the result of a release with --save <release>.
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from azure_rm_groups import AZURE_RM, load_azure_rm, make_hosts
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "azure_rm_startup.json")
+SUBSCRIPTION_ID = "00000000-0000-0000-0000-000000000000"
+
+
+def write_cache(azure_rm, cache_path, hosts):
+    """ Write the cache file the default settings of azure_rm.py look up for SUBSCRIPTION_ID """
+    inventory = azure_rm.AzureInventory.__new__(azure_rm.AzureInventory)
+    inventory.resource_groups = []
+    inventory.tags = None
+    inventory.locations = None
+    inventory.include_powerstate = True
+    inventory.use_private_ip = False
+    inventory.minimal = False
+    inventory.cache_path = cache_path
+    with open(inventory._cache_file(SUBSCRIPTION_ID), "w") as f:
+        json.dump(dict(version=azure_rm.AZURE_CACHE_VERSION, hosts=hosts, fingerprints=dict()), f)
+
+
+def timed(argv, env, status, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, AZURE_RM] + argv, env=env, stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+        if process.returncode != status:
+            sys.exit("azure_rm.py %s exited with %d, expected %d" % (" ".join(argv), process.returncode, status))
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hosts", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--save", metavar="RELEASE", help="Record the results in azure_rm_startup.json")
+    args = parser.parse_args()
+
+    azure_rm = load_azure_rm()
+    env = dict((key, value) for key, value in os.environ.items() if not key.startswith("AZURE_"))
+    with tempfile.TemporaryDirectory() as cache_path:
+        write_cache(azure_rm, cache_path, make_hosts(args.hosts, 5))
+        env.update(AZURE_SUBSCRIPTION_ID=SUBSCRIPTION_ID, AZURE_CACHE_PATH=cache_path, AZURE_CACHE_MAX_AGE="86400")
+        results = dict(
+            cache_hit=timed(["--list"], env, 0, args.repeat),
+            argument_error=timed(["--list", "--workers", "many"], env, 2, args.repeat),
+        )
+
+    with open(BASELINE) as f:
+        baseline = json.load(f)
+    previous = baseline[-1] if baseline else None
+
+    print("azure_rm startup, %d cached hosts, median of %d runs" % (args.hosts, args.repeat))
+    for name, elapsed in sorted(results.items()):
+        line = "%-15s %8.3fs" % (name, elapsed)
+        if previous:
+            line += "  %+6.0f%% vs %s" % ((elapsed / previous[name] - 1) * 100, previous["release"])
+        print(line)
+
+    if args.save:
+        baseline.append(dict(release=args.save, hosts=args.hosts,
+                             **dict((name, round(elapsed, 3)) for name, elapsed in results.items())))
+        with open(BASELINE, "w") as f:
+            json.dump(baseline, f, indent=2)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
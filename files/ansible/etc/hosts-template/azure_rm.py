@@ -71,8 +71,14 @@ Environment variables:
 
 Run for Specific Host
 -----------------------
-When run for a specific host using the --host option, a resource group is
-required. For a specific host, this script returns the following variables:
+When run for a specific host using the --host option, the machine is looked up
+directly instead of listing the whole subscription: with a GET in each of the
+resource groups given with --resource-groups (or AZURE_RESOURCE_GROUPS) when
+set, otherwise through a resource listing filtered on the host name. Only the
+network interfaces and public IPs of that machine are fetched, and a fresh
+inventory cache answers without any API call. The host must still match the
+tags and locations filters. For a specific host, this script returns the
+following variables:
 
 {
   "ansible_host": "XXX.XXX.XXX.XXX",
@@ -136,6 +142,16 @@ Select hosts within specific resource groups by assigning a comma separated list
 
 AZURE_RESOURCE_GROUPS=resource_group_a,resource_group_b
 
+Several subscriptions can be enumerated into a single inventory by giving a comma separated list of
+subscription ids, with --subscription_id or:
+
+AZURE_SUBSCRIPTION_ID=subscription_a,subscription_b
+
+All subscriptions use the same credentials. Each resource group (or whole subscription) is listed on the
+worker pool when AZURE_WORKERS is above 1, and results are merged in the order subscriptions and resource
+groups are given. When two machines end up with the same host name, the first one listed is kept and the
+others are reported on stderr.
+
 Select hosts for specific tag key by assigning a comma separated list of tag keys to:
 
 AZURE_TAGS=key1,key2,key3
@@ -151,6 +167,95 @@ AZURE_TAGS=key1:value1,key2:value2
 If you don't need the powerstate, you can improve performance by turning off powerstate fetching:
 AZURE_INCLUDE_POWERSTATE=no
 
+Network interfaces, public IP addresses and power states are resolved one machine after the other by
+default. To resolve them on a pool of concurrent workers, set the number of workers with --workers or:
+AZURE_WORKERS=16
+Hosts and groups are still added in the order the machines are listed, so the output stays the same.
+
+Machines are streamed rather than downloaded all at once: each listing is read on its own thread, up to
+AZURE_READ_AHEAD machines ahead of the hosts being resolved, so the next page is fetched while the current one
+is processed. At most AZURE_WORKERS listings are read at the same time, and at most 4 hosts per worker are
+resolved ahead of the inventory being built. Repeated host var values (locations, resource groups, sizes,
+images, tags...) are shared between hosts, and the inventory is written out one host at a time.
+
+Instead of one request per network interface and per public IP address, all of them can be listed once
+for the subscription (or for each of the selected resource groups) and joined to the machines in memory:
+AZURE_PREFETCH_NETWORK=yes
+
+The powerstate normally costs one instance view request per host. It can instead be read for every machine
+of the subscription from a single paged listing of virtual machine statuses:
+AZURE_BULK_POWERSTATE=yes
+The number of compute API calls saved this way is reported on stderr.
+
+Azure Resource Manager throttles subscriptions sending too many reads (HTTP 429). Such calls are retried
+rather than failing the inventory, up to --max-retries times or:
+AZURE_MAX_RETRIES=5
+All calls then wait for the Retry-After delay sent by Azure (or an exponential backoff without one), and the
+number of calls in flight, at most twice AZURE_WORKERS since listings are read ahead on their own threads, is
+halved. It grows back by one after as many successful calls as the current limit, and is capped in proportion
+to the x-ms-ratelimit-remaining-subscription-reads quota once fewer than 100 reads remain. Throttled calls and
+the lowest concurrency reached are reported on stderr.
+
+Security groups are listed once per resource group, the first time a machine of that resource group is met.
+To build the network interface to security group mapping from a single listing of each subscription instead:
+AZURE_PREFETCH_SECURITY_GROUPS=yes
+
+Minimal mode:
+-------------
+When hosts are only needed to connect to them and to group them by location, resource group, OS family and
+tags, every optional lookup can be skipped with --minimal or:
+AZURE_MINIMAL=yes
+Power states and security groups are not looked up (so hosts are not grouped by security group), and public
+IP addresses are not fetched when AZURE_USE_PRIVATE_IP is set. The image and windows_* host vars are left
+out, while ansible_connection is still set to winrm for Windows hosts. The number of API calls avoided is
+reported on stderr.
+
+API profile:
+------------
+To find out where the time of a run goes, every Azure API call can be counted and timed by operation
+(virtual_machines.list_all, virtual_machines.instance_view, network_interfaces.get...), with --inventory-profile
+or:
+AZURE_INVENTORY_PROFILE=/path/to/profile.json
+The JSON summary is written to that file, or to stderr when the path is '-' or --inventory-profile is given no
+path. Time spent iterating the pages of a listing is counted in the listing operation. It also reports errors by
+status code, throttled (HTTP 429) calls, the retries made by the HTTP layer and the lowest remaining reads quota
+returned by Azure Resource Manager, and under throttle the retries, time waited, and lowest and final concurrency
+of the throttling described above. The inventory written to stdout is unchanged.
+
+Resource Graph backend:
+-----------------------
+By default machines are listed with the compute API, and the tags and locations filters are applied once every
+machine has been downloaded. The resource_graph backend instead sends a single Azure Resource Graph query, which
+applies the resource groups, tags and locations filters server-side and returns the selected machines together
+with their network interfaces and public IP addresses (and power states):
+AZURE_INVENTORY_BACKEND=resource_graph
+or --backend resource_graph. Host vars and groups are the same as with the default sdk backend. Network
+interfaces and public IPs that are missing from the query result are still fetched one by one. The
+AZURE_PREFETCH_NETWORK, AZURE_BULK_POWERSTATE and AZURE_PREFETCH_SECURITY_GROUPS settings have no effect with
+this backend. Only security groups attached to network interfaces are reported, as with the sdk backend.
+
+Inventory cache:
+----------------
+The inventory can be cached on disk, so that runs following each other within the cache max age (in seconds)
+neither authenticate, call the Azure API nor even import the Azure SDK:
+AZURE_CACHE_MAX_AGE=300
+AZURE_CACHE_PATH=~/.ansible/tmp
+Cache files are keyed on the subscription and on the resource groups, tags, locations, powerstate and
+private IP settings. They are written atomically, so runs sharing a cache directory never read a partial
+file. Use --refresh-cache to ignore the cache and rebuild it. The cache is disabled by default (max age 0).
+The subscription must be known without authenticating, from --subscription_id, AZURE_SUBSCRIPTION_ID or the
+profile: runs with MSI or Azure CLI credentials and no subscription set are not cached.
+
+Once the cache has expired, it can be refreshed incrementally instead of being rebuilt from scratch:
+AZURE_CACHE_INCREMENTAL=yes
+Machines are still listed, but network interfaces, public IPs, security groups and power states are only
+resolved again for machines that are new or whose provisioning state or network interfaces changed since
+the cached snapshot. Machines that are gone drop out of every group. --refresh-cache always does a full
+rebuild. Power states are refreshed for every machine from one listing of virtual machine statuses per
+subscription, as with AZURE_BULK_POWERSTATE, so that stopped machines are not reported running. Public IP
+addresses of unchanged machines still come from the snapshot, and so do their power states with older
+SDKs which cannot list statuses.
+
 azure_rm.ini
 ------------
 As mentioned above, you can control execution using environment variables or a .ini file. A sample
@@ -195,50 +300,85 @@ Version: 1.0.0
 '''
 
 import argparse
+import collections
+import copy
+import hashlib
+import itertools
 import json
 import os
+import queue
+import random
 import re
 import sys
 import inspect
+import tempfile
+import threading
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from os.path import expanduser
-from ansible.module_utils.six.moves import configparser as cp
-import ansible.module_utils.six.moves.urllib.parse as urlparse
+import configparser as cp
+import urllib.parse as urlparse
 
-HAS_AZURE = True
+# The Azure SDK is imported by load_azure_sdk(), once an API call is needed
+HAS_AZURE = None
 HAS_AZURE_EXC = None
-HAS_AZURE_CLI_CORE = True
-CLIError = None
-
-try:
-    from msrestazure.azure_active_directory import AADTokenCredentials
-    from msrestazure.azure_exceptions import CloudError
-    from msrestazure.azure_active_directory import MSIAuthentication
-    from msrestazure import azure_cloud
-    from azure.mgmt.compute import __version__ as azure_compute_version
-    from azure.common import AzureMissingResourceHttpError, AzureHttpError
-    from azure.common.credentials import ServicePrincipalCredentials, UserPassCredentials
-    from azure.mgmt.network import NetworkManagementClient
-    from azure.mgmt.resource.resources import ResourceManagementClient
-    from azure.mgmt.resource.subscriptions import SubscriptionClient
-    from azure.mgmt.compute import ComputeManagementClient
-    from adal.authentication_context import AuthenticationContext
-except ImportError as exc:
-    HAS_AZURE_EXC = exc
-    HAS_AZURE = False
-
-try:
-    from azure.cli.core.util import CLIError
-    from azure.common.credentials import get_azure_cli_credentials, get_cli_profile
-    from azure.common.cloud import get_cli_active_cloud
-except ImportError:
-    HAS_AZURE_CLI_CORE = False
-    CLIError = Exception
-
-try:
-    from ansible.release import __version__ as ansible_version
-except ImportError:
-    ansible_version = 'unknown'
+HAS_AZURE_CLI_CORE = None
+CLIError = Exception
+
+
+def load_azure_sdk():
+    '''
+    Import the Azure SDK. This takes longer than answering from the inventory cache or rejecting the command line
+    arguments, which is why it waits until the API is called. Returns whether the SDK is installed.
+    '''
+    global HAS_AZURE, HAS_AZURE_EXC, HAS_AZURE_CLI_CORE, CLIError
+    global AADTokenCredentials, CloudError, MSIAuthentication, azure_cloud, azure_compute_version
+    global AzureMissingResourceHttpError, AzureHttpError, ServicePrincipalCredentials, UserPassCredentials
+    global NetworkManagementClient, ResourceManagementClient, SubscriptionClient, ComputeManagementClient
+    global AuthenticationContext, get_azure_cli_credentials, get_cli_profile, get_cli_active_cloud
+
+    if HAS_AZURE is not None:
+        return HAS_AZURE
+
+    HAS_AZURE = True
+    try:
+        from msrestazure.azure_active_directory import AADTokenCredentials
+        from msrestazure.azure_exceptions import CloudError
+        from msrestazure.azure_active_directory import MSIAuthentication
+        from msrestazure import azure_cloud
+        from azure.mgmt.compute import __version__ as azure_compute_version
+        from azure.common import AzureMissingResourceHttpError, AzureHttpError
+        from azure.common.credentials import ServicePrincipalCredentials, UserPassCredentials
+        from azure.mgmt.network import NetworkManagementClient
+        from azure.mgmt.resource.resources import ResourceManagementClient
+        from azure.mgmt.resource.subscriptions import SubscriptionClient
+        from azure.mgmt.compute import ComputeManagementClient
+        from adal.authentication_context import AuthenticationContext
+    except ImportError as exc:
+        HAS_AZURE_EXC = exc
+        HAS_AZURE = False
+
+    HAS_AZURE_CLI_CORE = True
+    try:
+        from azure.cli.core.util import CLIError
+        from azure.common.credentials import get_azure_cli_credentials, get_cli_profile
+        from azure.common.cloud import get_cli_active_cloud
+    except ImportError:
+        HAS_AZURE_CLI_CORE = False
+        CLIError = Exception
+
+    return HAS_AZURE
+
+
+def ansible_user_agent():
+    ''' The User-Agent of the API calls, ansible is not imported before the first one either '''
+    try:
+        from ansible.release import __version__ as ansible_version
+    except ImportError:
+        ansible_version = 'unknown'
+    return 'Ansible/{0}'.format(ansible_version)
+
 
 AZURE_CREDENTIAL_ENV_MAPPING = dict(
     profile='AZURE_PROFILE',
@@ -262,11 +402,84 @@ AZURE_CONFIG_SETTINGS = dict(
     group_by_security_group='AZURE_GROUP_BY_SECURITY_GROUP',
     group_by_tag='AZURE_GROUP_BY_TAG',
     group_by_os_family='AZURE_GROUP_BY_OS_FAMILY',
-    use_private_ip='AZURE_USE_PRIVATE_IP'
+    use_private_ip='AZURE_USE_PRIVATE_IP',
+    workers='AZURE_WORKERS',
+    read_ahead='AZURE_READ_AHEAD',
+    prefetch_network='AZURE_PREFETCH_NETWORK',
+    bulk_powerstate='AZURE_BULK_POWERSTATE',
+    prefetch_security_groups='AZURE_PREFETCH_SECURITY_GROUPS',
+    backend='AZURE_INVENTORY_BACKEND',
+    minimal='AZURE_MINIMAL',
+    inventory_profile='AZURE_INVENTORY_PROFILE',
+    max_retries='AZURE_MAX_RETRIES',
+    cache_path='AZURE_CACHE_PATH',
+    cache_max_age='AZURE_CACHE_MAX_AGE',
+    cache_incremental='AZURE_CACHE_INCREMENTAL'
+)
+
+AZURE_INTEGER_SETTINGS = ('workers', 'cache_max_age', 'read_ahead', 'max_retries')
+AZURE_STRING_SETTINGS = ('cache_path', 'backend', 'inventory_profile')
+
+AZURE_INVENTORY_BACKENDS = ('sdk', 'resource_graph')
+
+AZURE_RESOURCE_GRAPH_API_VERSION = '2021-03-01'
+AZURE_RESOURCE_GRAPH_PAGE_SIZE = 1000
+
+# Resource Graph returns resource types in lower case, the SDK models in their canonical form
+AZURE_RESOURCE_GRAPH_TYPES = dict((resource_type.lower(), resource_type) for resource_type in (
+    'Microsoft.Compute/virtualMachines',
+    'Microsoft.Network/networkInterfaces',
+    'Microsoft.Network/publicIPAddresses',
+))
+
+# Throttled calls wait for Retry-After when Azure sends it, otherwise for an exponential backoff capped at
+# AZURE_THROTTLE_MAX_DELAY seconds. Concurrency is lowered once the remaining reads quota of the subscription
+# falls below AZURE_THROTTLE_LOW_READS.
+AZURE_THROTTLE_MAX_DELAY = 60
+AZURE_THROTTLE_LOW_READS = 100
+
+# Bump when the layout of the cache files changes, older files are then ignored
+AZURE_CACHE_VERSION = 2
+
+# Host vars whose values repeat across hosts, stored once for all of them
+AZURE_SHARED_HOST_VARS = (
+    'location',
+    'type',
+    'resource_group',
+    'plan',
+    'virtual_machine_size',
+    'provisioning_state',
+    'powerstate',
+    'private_ip_alloc_method',
+    'public_ip_alloc_method',
+    'security_group',
+    'security_group_id',
+    'ansible_connection',
+)
+
+# Host vars which come from network and instance view lookups rather than from the listed machine itself.
+# An incremental cache refresh copies them from the snapshot for machines that did not change.
+AZURE_RESOLVED_HOST_VARS = (
+    'ansible_host',
+    'private_ip',
+    'private_ip_alloc_method',
+    'public_ip',
+    'public_ip_name',
+    'public_ip_id',
+    'public_ip_alloc_method',
+    'fqdn',
+    'network_interface_id',
+    'network_interface',
+    'mac_address',
+    'security_group',
+    'security_group_id',
 )
 
+# Characters replaced by underscores in group names, with and without replace_dash_in_groups
+AZURE_UNSAFE_GROUP_CHARS = re.compile(r"[^A-Za-z0-9\_]")
+AZURE_UNSAFE_GROUP_CHARS_KEEP_DASH = re.compile(r"[^A-Za-z0-9\_\-]")
+
 AZURE_MIN_VERSION = "2.0.0"
-ANSIBLE_USER_AGENT = 'Ansible/{0}'.format(ansible_version)
 
 
 def azure_id_to_dict(id):
@@ -279,12 +492,350 @@ def azure_id_to_dict(id):
     return result
 
 
+def camel_to_snake(name):
+    ''' Convert a camelCase REST API key to the snake_case attribute name used by the SDK models '''
+    name = re.sub(r'([A-Z]+)([A-Z][a-z])', r'\1_\2', name)
+    return re.sub(r'([a-z0-9])([A-Z])', r'\1_\2', name).lower()
+
+
+class ResourceGraphEnum(object):
+    ''' Stands for the SDK enum of a value returned by Resource Graph '''
+
+    def __init__(self, value):
+        self.value = value
+        self.name = value.lower()
+
+
+class ResourceGraphRecord(object):
+    '''
+    A resource returned by Resource Graph, exposed like the SDK models: the properties are flattened,
+    keys become snake_case attributes, and attributes missing from the result are None.
+    '''
+
+    def __init__(self, values):
+        values = dict(values)
+        values.update(values.pop('properties', None) or {})
+        for key, value in values.items():
+            attribute = camel_to_snake(key)
+            if attribute == 'tags':
+                value = value or None
+            elif attribute == 'type' and value:
+                value = AZURE_RESOURCE_GRAPH_TYPES.get(value.lower(), value)
+            elif attribute in ('os_type', 'protocol') and value is not None:
+                value = ResourceGraphEnum(value)
+            else:
+                value = self._convert(value)
+            setattr(self, attribute, value)
+
+    def __getattr__(self, name):
+        # Only called for attributes the result did not include
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return None
+
+    def _convert(self, value):
+        if isinstance(value, dict):
+            return ResourceGraphRecord(value)
+        if isinstance(value, list):
+            return [self._convert(item) for item in value]
+        return value
+
+
+class AzureProfiler(object):
+    ''' Counts and times the Azure API calls made through ThrottledClient, by operation '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._operations = dict()
+        self._responses = dict(count=0, retries=0, throttled=0, status=dict())
+        self._remaining_reads = None
+
+    def record(self, operation, seconds, calls=0, items=0, exc=None):
+        with self._lock:
+            stats = self._operations.get(operation)
+            if stats is None:
+                stats = self._operations[operation] = dict(calls=0, items=0, errors=0, throttled=0, seconds=0.0)
+            stats['calls'] += calls
+            stats['items'] += items
+            stats['seconds'] += seconds
+            if exc is not None:
+                stats['errors'] += 1
+                if getattr(exc, 'status_code', None) == 429:
+                    stats['throttled'] += 1
+
+    def response_hook(self, response, *args, **kwargs):
+        ''' requests response hook, sees every response of the clients, after the retries of the HTTP layer '''
+        history = getattr(getattr(getattr(response, 'raw', None), 'retries', None), 'history', None) or ()
+        statuses = [retry.status for retry in history if retry.status] + [response.status_code]
+        remaining = response.headers.get('x-ms-ratelimit-remaining-subscription-reads')
+        with self._lock:
+            self._responses['count'] += 1
+            self._responses['retries'] += len(history)
+            for status in statuses:
+                self._responses['status'][str(status)] = self._responses['status'].get(str(status), 0) + 1
+                if status == 429:
+                    self._responses['throttled'] += 1
+            if remaining and remaining.isdigit() and \
+               (self._remaining_reads is None or int(remaining) < self._remaining_reads):
+                self._remaining_reads = int(remaining)
+        return response
+
+    def summary(self):
+        with self._lock:
+            operations = dict((operation, dict(stats, seconds=round(stats['seconds'], 3)))
+                              for operation, stats in self._operations.items())
+            return dict(
+                seconds=round(time.time() - self._started, 3),
+                calls=sum(stats['calls'] for stats in operations.values()),
+                operations=operations,
+                responses=copy.deepcopy(self._responses),
+                remaining_subscription_reads=self._remaining_reads,
+            )
+
+
+class AzureThrottle(object):
+    '''
+    Shared by the clients of every subscription: bounds the number of Azure API calls in flight, and retries the
+    calls throttled by Azure Resource Manager (HTTP 429). Each throttled call halves the concurrency and pauses
+    every call for Retry-After, then the concurrency grows back by one after as many successful calls as the
+    current limit. It is also capped in proportion to the remaining reads quota once that runs low.
+    '''
+
+    def __init__(self, max_concurrency, retries):
+        self._condition = threading.Condition()
+        self._max_concurrency = max(max_concurrency, 1)
+        self._ceiling = self._max_concurrency
+        self._concurrency = self._max_concurrency
+        self._lowest_concurrency = self._max_concurrency
+        self._active = 0
+        self._successes = 0
+        self._resume_at = 0.0
+        self._retries = max(retries, 0)
+        self._throttled = 0
+        self._retried = 0
+        self._waited = 0.0
+
+    def call(self, function):
+        ''' Call function once a slot is free, again while it is throttled, up to the number of retries '''
+        attempt = 0
+        while True:
+            self._acquire()
+            try:
+                result = function()
+            except Exception as exc:
+                if not self._release_throttled(exc, attempt):
+                    raise
+                attempt += 1
+                continue
+            self._release()
+            return result
+
+    def response_hook(self, response, *args, **kwargs):
+        ''' requests response hook, follows the remaining reads quota and the 429 retried by the HTTP layer '''
+        remaining = response.headers.get('x-ms-ratelimit-remaining-subscription-reads')
+        history = getattr(getattr(getattr(response, 'raw', None), 'retries', None), 'history', None) or ()
+        with self._condition:
+            if remaining and remaining.isdigit():
+                ceiling = self._max_concurrency
+                if int(remaining) < AZURE_THROTTLE_LOW_READS:
+                    ceiling = max(self._max_concurrency * int(remaining) // AZURE_THROTTLE_LOW_READS, 1)
+                self._ceiling = ceiling
+                # Azure sends the quota with every response, only a ceiling under the concurrency lowers it
+                if ceiling < self._concurrency:
+                    self._lower(ceiling)
+            for retry in history:
+                if retry.status == 429:
+                    self._throttled += 1
+                    self._lower(self._concurrency // 2)
+            self._condition.notify_all()
+        return response
+
+    def summary(self):
+        with self._condition:
+            return dict(
+                max_concurrency=self._max_concurrency,
+                lowest_concurrency=self._lowest_concurrency,
+                concurrency=self._concurrency,
+                throttled=self._throttled,
+                retries=self._retried,
+                waited=round(self._waited, 3),
+            )
+
+    def _acquire(self):
+        with self._condition:
+            while True:
+                pause = self._resume_at - time.time()
+                if pause > 0:
+                    self._condition.wait(pause)
+                elif self._active >= self._concurrency:
+                    self._condition.wait()
+                else:
+                    break
+            self._active += 1
+
+    def _release(self):
+        with self._condition:
+            self._active -= 1
+            if self._concurrency < self._ceiling:
+                self._successes += 1
+                if self._successes >= self._concurrency:
+                    self._concurrency += 1
+                    self._successes = 0
+            self._condition.notify_all()
+
+    def _release_throttled(self, exc, attempt):
+        ''' Release the slot of a failed call, returns whether to retry it '''
+        response = getattr(exc, 'response', None)
+        status_code = getattr(exc, 'status_code', None) or getattr(response, 'status_code', None)
+        if status_code != 429:
+            self._release()
+            return False
+        retry_after = (getattr(response, 'headers', None) or {}).get('Retry-After', '')
+        if retry_after.isdigit():
+            delay = int(retry_after)
+        else:
+            delay = min(2 ** attempt, AZURE_THROTTLE_MAX_DELAY) * random.uniform(0.5, 1.0)
+        with self._condition:
+            self._active -= 1
+            self._throttled += 1
+            # Calls throttled together lower the concurrency once, not once each
+            if time.time() >= self._resume_at:
+                self._lower(self._concurrency // 2)
+            if attempt >= self._retries:
+                self._condition.notify_all()
+                return False
+            self._retried += 1
+            now = time.time()
+            if now + delay > self._resume_at:
+                self._waited += now + delay - max(self._resume_at, now)
+                self._resume_at = now + delay
+            self._condition.notify_all()
+        return True
+
+    def _lower(self, concurrency):
+        # Called with the condition held
+        self._concurrency = max(min(self._concurrency, concurrency), 1)
+        self._lowest_concurrency = min(self._lowest_concurrency, self._concurrency)
+        self._successes = 0
+
+
+class ThrottledClient(object):
+    ''' Wraps an SDK management client, so that the calls to its operation groups go through the throttle, and
+        through the profiler when there is one '''
+
+    def __init__(self, client, throttle, profiler=None):
+        self._client = client
+        self._throttle = throttle
+        self._profiler = profiler
+        self._groups = dict()
+        hooks = getattr(getattr(client, 'config', None), 'hooks', None)
+        if isinstance(hooks, list):
+            hooks.append(throttle.response_hook)
+            if profiler is not None:
+                hooks.append(profiler.response_hook)
+
+    def __getattr__(self, name):
+        value = getattr(self._client, name)
+        if name.startswith('_') or name == 'config' or callable(value) or \
+           isinstance(value, (str, int, float, bool, type(None))):
+            return value
+        if name not in self._groups:
+            self._groups[name] = ThrottledOperations(value, name, self._throttle, self._profiler)
+        return self._groups[name]
+
+
+class ThrottledOperations(object):
+    ''' An operation group (virtual_machines, network_interfaces...) whose calls are throttled and profiled '''
+
+    def __init__(self, operations, name, throttle, profiler):
+        self._operations = operations
+        self._name = name
+        self._throttle = throttle
+        self._profiler = profiler
+
+    def __getattr__(self, name):
+        method = getattr(self._operations, name)
+        if name.startswith('_') or not callable(method):
+            return method
+        throttle = self._throttle
+        profiler = self._profiler
+        group = self._name
+
+        def throttled(*args, **kwargs):
+            if kwargs.get('expand') == 'instanceview':
+                operation = '{0}.instance_view'.format(group)
+            elif kwargs.get('status_only'):
+                operation = '{0}.{1}(status_only)'.format(group, name)
+            else:
+                operation = '{0}.{1}'.format(group, name)
+
+            def call():
+                start = time.time()
+                try:
+                    result = method(*args, **kwargs)
+                except Exception as exc:
+                    if profiler is not None:
+                        profiler.record(operation, time.time() - start, calls=1, exc=exc)
+                    raise
+                if profiler is not None:
+                    profiler.record(operation, time.time() - start, calls=1)
+                return result
+
+            result = throttle.call(call)
+            if hasattr(result, '__next__'):
+                return ThrottledPages(result, operation, throttle, profiler)
+            return result
+        return throttled
+
+
+class ThrottledPages(object):
+    ''' A pager whose iteration, which fetches the pages, is throttled and counted in the time of its operation '''
+
+    def __init__(self, pages, operation, throttle, profiler):
+        self._pages = pages
+        self._operation = operation
+        self._throttle = throttle
+        self._profiler = profiler
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # A failed page is fetched again by the next call, retrying it picks up where the listing stopped
+        return self._throttle.call(self._next)
+
+    next = __next__
+
+    def _next(self):
+        start = time.time()
+        try:
+            item = next(self._pages)
+        except StopIteration:
+            if self._profiler is not None:
+                self._profiler.record(self._operation, time.time() - start)
+            raise
+        except Exception as exc:
+            if self._profiler is not None:
+                self._profiler.record(self._operation, time.time() - start, exc=exc)
+            raise
+        if self._profiler is not None:
+            self._profiler.record(self._operation, time.time() - start, items=1)
+        return item
+
+    def __getattr__(self, name):
+        return getattr(self._pages, name)
+
+
 class AzureRM(object):
 
-    def __init__(self, args):
+    def __init__(self, args, profiler=None, throttle=None):
         self._args = args
+        self._profiler = profiler
+        self._throttle = throttle
         self._cloud_environment = None
         self._compute_client = None
+        self._compute_status_client = None
         self._resource_client = None
         self._network_client = None
         self._adfs_authority_url = None
@@ -322,7 +873,9 @@ class AzureRM(object):
         if self.credentials.get('subscription_id', None) is None:
             self.fail("Credentials did not include a subscription_id value.")
         self.log("setting subscription_id")
-        self.subscription_id = self.credentials['subscription_id']
+        self.subscription_ids = [subscription_id.strip() for subscription_id in
+                                 str(self.credentials['subscription_id']).split(',') if subscription_id.strip()]
+        self.subscription_id = self.subscription_ids[0]
 
         # get authentication authority
         # for adfs, user could pass in authority or not.
@@ -500,6 +1053,50 @@ class AzureRM(object):
         token_response = context.acquire_token_with_username_password(resource, username, password, client_id)
         return AADTokenCredentials(token_response)
 
+    def for_subscription(self, subscription_id):
+        ''' Return an AzureRM sharing these credentials, whose clients are bound to subscription_id '''
+        if subscription_id == self.subscription_id:
+            return self
+        rm = copy.copy(self)
+        rm.subscription_id = subscription_id
+        rm._compute_client = None
+        rm._compute_status_client = None
+        rm._resource_client = None
+        rm._network_client = None
+        return rm
+
+    def query_resource_graph(self, query):
+        ''' Run a Resource Graph query over all the subscriptions, yielding the rows of every page '''
+        url = '{0}/providers/Microsoft.ResourceGraph/resources?api-version={1}'.format(
+            self._cloud_environment.endpoints.resource_manager.rstrip('/'), AZURE_RESOURCE_GRAPH_API_VERSION)
+        session = self.azure_credentials.signed_session()
+        session.headers['User-Agent'] = ansible_user_agent()
+        options = {'$top': AZURE_RESOURCE_GRAPH_PAGE_SIZE, 'resultFormat': 'objectArray'}
+        if self._profiler is not None:
+            session.hooks['response'].append(self._profiler.response_hook)
+
+        def post():
+            start = time.time()
+            response = session.post(url, json=dict(subscriptions=self.subscription_ids, query=query, options=options))
+            if self._profiler is not None:
+                self._profiler.record('resource_graph.resources', time.time() - start, calls=1)
+            if response.status_code == 429:
+                # Raised for the throttle to retry, or for the caller to report once out of retries
+                response.raise_for_status()
+            return response
+
+        while True:
+            response = self._throttle.call(post) if self._throttle is not None else post()
+            if response.status_code != 200:
+                self.fail("Resource Graph query failed with status {0} - {1}".format(response.status_code,
+                                                                                     response.text))
+            result = response.json()
+            for row in result.get('data') or []:
+                yield row
+            if not result.get('$skipToken'):
+                return
+            options['$skipToken'] = result['$skipToken']
+
     def _register(self, key):
         try:
             # We have to perform the one-time registration here. Otherwise, we receive an error the first
@@ -518,7 +1115,9 @@ class AzureRM(object):
                              self.subscription_id,
                              base_url=base_url,
                              api_version=api_version)
-        client.config.add_user_agent(ANSIBLE_USER_AGENT)
+        client.config.add_user_agent(ansible_user_agent())
+        if self._throttle is not None:
+            return ThrottledClient(client, self._throttle, self._profiler)
         return client
 
     @property
@@ -550,6 +1149,16 @@ class AzureRM(object):
             self._register('Microsoft.Compute')
         return self._compute_client
 
+    @property
+    def compute_status_client(self):
+        # Listing the status of every machine at once needs a more recent API version than compute_client
+        self.log('Getting compute status client')
+        if not self._compute_status_client:
+            self._compute_status_client = self.get_mgmt_svc_client(ComputeManagementClient,
+                                                                   self._cloud_environment.endpoints.resource_manager,
+                                                                   '2021-03-01')
+        return self._compute_status_client
+
 
 class AzureInventory(object):
 
@@ -557,15 +1166,16 @@ class AzureInventory(object):
 
         self._args = self._parse_cli_args()
 
-        try:
-            rm = AzureRM(self._args)
-        except Exception as e:
-            sys.exit("{0}".format(str(e)))
-
-        self._compute_client = rm.compute_client
-        self._network_client = rm.network_client
-        self._resource_client = rm.rm_client
-        self._security_groups = None
+        self._rms = []
+        self._rms_by_subscription = dict()
+        self._security_groups = dict()
+        self._security_groups_loaded = set()
+        self._network_interfaces = None
+        self._public_ip_addresses = None
+        self._powerstates = None
+        self._powerstate_hits = 0
+        self._powerstate_requests = 0
+        self._counters_lock = threading.Lock()
 
         self.resource_groups = []
         self.tags = None
@@ -578,13 +1188,30 @@ class AzureInventory(object):
         self.group_by_tag = True
         self.include_powerstate = True
         self.use_private_ip = False
-
-        self._inventory = dict(
-            _meta=dict(
-                hostvars=dict()
-            ),
-            azure=[]
-        )
+        self.workers = 1
+        self.read_ahead = 500
+        self.prefetch_network = False
+        self.bulk_powerstate = False
+        self.prefetch_security_groups = False
+        self.backend = 'sdk'
+        self.minimal = False
+        self.inventory_profile = None
+        self.max_retries = 5
+        self.cache_path = '~/.ansible/tmp'
+        self.cache_max_age = 0
+        self.cache_incremental = False
+        self._executor = None
+        self._snapshot = None
+        self._fingerprints = dict()
+        self._resolved_hosts = 0
+        self._skip_powerstate = False
+        self._skip_security_groups = False
+        self._avoided_calls = 0
+        self._shared_values = dict()
+        self._profiler = None
+        self._throttle = None
+
+        self._reset_inventory()
 
         self._get_settings()
 
@@ -600,8 +1227,107 @@ class AzureInventory(object):
         if self._args.no_powerstate:
             self.include_powerstate = False
 
-        self.get_inventory()
-        print(self._json_format_dict(pretty=self._args.pretty))
+        if self._args.workers is not None:
+            self.workers = self._args.workers
+
+        if self._args.prefetch_network:
+            self.prefetch_network = True
+
+        if self._args.bulk_powerstate:
+            self.bulk_powerstate = True
+
+        if self._args.prefetch_security_groups:
+            self.prefetch_security_groups = True
+
+        if self._args.backend:
+            self.backend = self._args.backend
+
+        if self.backend not in AZURE_INVENTORY_BACKENDS:
+            sys.exit("Error: backend must be one of {0}, got '{1}'".format(', '.join(AZURE_INVENTORY_BACKENDS),
+                                                                          self.backend))
+
+        if self._args.minimal:
+            self.minimal = True
+
+        if self._args.inventory_profile:
+            self.inventory_profile = self._args.inventory_profile
+
+        if self._args.max_retries is not None:
+            self.max_retries = self._args.max_retries
+
+        if self.inventory_profile:
+            self._profiler = AzureProfiler()
+
+        # The listings are read on their own threads, next to the workers resolving hosts
+        self._throttle = AzureThrottle(max(self.workers, 1) * 2, self.max_retries)
+
+        if self.minimal:
+            # Remember which lookups are skipped, to report the API calls they would have cost
+            self._skip_powerstate = self.include_powerstate
+            self._skip_security_groups = self.group_by_security_group
+            self.include_powerstate = False
+            self.group_by_security_group = False
+
+        cache_file = None
+        if self.cache_max_age > 0:
+            subscription_id = self._cache_subscription_id()
+            if subscription_id:
+                cache_file = self._cache_file(subscription_id)
+                if not self._args.refresh_cache and self._load_cache(cache_file):
+                    self._write_profile()
+                    self._write_inventory(sys.stdout, pretty=self._args.pretty)
+                    sys.exit(0)
+                if self.cache_incremental and not self._args.refresh_cache:
+                    self._load_snapshot(cache_file)
+
+        if not load_azure_sdk():
+            sys.exit("The Azure python sdk is not installed (try `pip install 'azure>={0}' --upgrade`) - {1}".format(
+                AZURE_MIN_VERSION, HAS_AZURE_EXC))
+
+        try:
+            rm = AzureRM(self._args, profiler=self._profiler, throttle=self._throttle)
+        except Exception as e:
+            sys.exit("{0}".format(str(e)))
+
+        for subscription_id in rm.subscription_ids:
+            subscription_rm = rm.for_subscription(subscription_id)
+            if self.backend == 'sdk':
+                # Create the clients now rather than lazily from the workers
+                subscription_rm.compute_client
+                subscription_rm.network_client
+                subscription_rm.rm_client
+            self._rms.append(subscription_rm)
+            self._rms_by_subscription[subscription_id.lower()] = subscription_rm
+
+        if self.workers > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            self.get_inventory()
+        finally:
+            if self._executor:
+                self._executor.shutdown()
+        if self._powerstates is not None and self.bulk_powerstate and self.backend == 'sdk':
+            # Every page of the subscription listings is a request of its own
+            sys.stderr.write("azure_rm: bulk powerstate listing saved {0} compute API calls\n".format(
+                max(self._powerstate_hits - self._powerstate_requests, 0)))
+        if self.minimal:
+            sys.stderr.write("azure_rm: minimal mode avoided {0} API calls\n".format(self._avoided_calls))
+        throttle = self._throttle.summary()
+        if throttle['throttled']:
+            sys.stderr.write("azure_rm: {0} API calls throttled, {1} retried after waiting {2}s in total, "
+                             "concurrency lowered to {3} of {4}\n".format(throttle['throttled'],
+                                                                         throttle['retries'],
+                                                                         throttle['waited'],
+                                                                         throttle['lowest_concurrency'],
+                                                                         throttle['max_concurrency']))
+        if self._snapshot is not None:
+            sys.stderr.write("azure_rm: incremental refresh resolved {0} of {1} hosts\n".format(
+                self._resolved_hosts, len(self._hosts)))
+        # Without a subscription known before authenticating, no later run could look the cache up
+        if cache_file and not self._args.host:
+            self._write_cache(cache_file)
+        self._write_profile()
+        self._write_inventory(sys.stdout, pretty=self._args.pretty)
         sys.exit(0)
 
     def _parse_cli_args(self):
@@ -619,7 +1345,7 @@ class AzureInventory(object):
         parser.add_argument('--profile', action='store',
                             help='Azure profile contained in ~/.azure/credentials')
         parser.add_argument('--subscription_id', action='store',
-                            help='Azure Subscription Id')
+                            help='Azure Subscription Id, or comma separated list of Subscription Ids')
         parser.add_argument('--client_id', action='store',
                             help='Azure Client Id ')
         parser.add_argument('--secret', action='store',
@@ -642,222 +1368,793 @@ class AzureInventory(object):
                             help='Return inventory for comma separated list of locations')
         parser.add_argument('--no-powerstate', action='store_true', default=False,
                             help='Do not include the power state of each virtual host')
+        parser.add_argument('--workers', action='store', type=int,
+                            help='Number of concurrent workers resolving network interfaces, public IPs '
+                                 'and power states (default: 1)')
+        parser.add_argument('--prefetch-network', action='store_true', default=False,
+                            help='List all network interfaces and public IPs once instead of fetching them per host')
+        parser.add_argument('--bulk-powerstate', action='store_true', default=False,
+                            help='Read the power state of all hosts from one listing instead of one call per host')
+        parser.add_argument('--prefetch-security-groups', action='store_true', default=False,
+                            help='List the security groups of each subscription once instead of per resource group')
+        parser.add_argument('--minimal', action='store_true', default=False,
+                            help='Only look up what is needed to connect to and group hosts: no power state, '
+                                 'security groups, image or windows details')
+        parser.add_argument('--inventory-profile', action='store', nargs='?', const='-', metavar='PATH',
+                            help='Count and time the Azure API calls, and write a JSON summary to PATH '
+                                 '(default: stderr)')
+        parser.add_argument('--max-retries', action='store', type=int,
+                            help='Number of times an API call throttled by Azure is retried (default: 5)')
+        parser.add_argument('--backend', action='store', choices=AZURE_INVENTORY_BACKENDS,
+                            help='List machines with the compute API (sdk, default) or with one Azure Resource Graph '
+                                 'query filtered server-side (resource_graph)')
+        parser.add_argument('--refresh-cache', action='store_true', default=False,
+                            help='Ignore the inventory cache and rebuild it from the Azure API')
         return parser.parse_args()
 
     def get_inventory(self):
-        if len(self.resource_groups) > 0:
+        if self.backend == 'resource_graph':
+            self._load_machines(self._query_resource_graph(self._args.host))
+            return
+
+        if self._args.host:
+            self._load_machines(self._get_host_machines(self._args.host))
+            return
+
+        if self.prefetch_network:
+            self._prefetch_network()
+
+        if self.include_powerstate and self._lists_powerstates():
+            self._prefetch_powerstates()
+        elif self._skip_powerstate and self._lists_powerstates():
+            self._avoided_calls += len(self._rms)
+
+        if self.group_by_security_group and self.prefetch_security_groups:
+            self._prefetch_security_groups()
+        elif self._skip_security_groups and self.prefetch_security_groups:
+            for rm in self._rms:
+                self._skip_security_groups_listing(rm, None)
+
+        self._load_machines(self._stream_machines())
+
+    def _scopes(self):
+        ''' The (AzureRM, resource group) pairs to enumerate, in output order. A None resource group stands
+            for the whole subscription. '''
+        resource_groups = [resource_group.lower() for resource_group in self.resource_groups] or [None]
+        return [(rm, resource_group) for rm in self._rms for resource_group in resource_groups]
+
+    def _stream_machines(self):
+        ''' Yield the machines of every scope in output order. Scopes are listed on reader threads, up to
+            self.workers of them at once, each reading at most self.read_ahead machines ahead. '''
+        scopes = iter(self._scopes())
+        readers = collections.deque(self._read_ahead(self._list_machines(scope))
+                                    for scope in itertools.islice(scopes, max(self.workers, 1)))
+        while readers:
+            reader = readers.popleft()
+            for scope in itertools.islice(scopes, 1):
+                readers.append(self._read_ahead(self._list_machines(scope)))
+            for machine in reader:
+                yield machine
+
+    def _read_ahead(self, items):
+        ''' Iterate items on a reader thread, so that the pager fetches the next page while the caller is busy
+            with the current one. Errors, sys.exit included, are raised again in the caller. '''
+        buffer = queue.Queue(maxsize=max(self.read_ahead, 1))
+        end = object()
+
+        def read():
+            try:
+                for item in items:
+                    buffer.put((item, None))
+                buffer.put((end, None))
+            except BaseException as exc:
+                buffer.put((end, exc))
+
+        reader = threading.Thread(target=read)
+        reader.daemon = True
+        reader.start()
+
+        def consume():
+            while True:
+                item, exc = buffer.get()
+                if item is end:
+                    if exc is not None:
+                        raise exc
+                    return
+                yield item
+        return consume()
+
+    def _list_machines(self, scope):
+        rm, resource_group = scope
+        if resource_group:
             # get VMs for requested resource groups
-            for resource_group in self.resource_groups:
-                try:
-                    virtual_machines = self._compute_client.virtual_machines.list(resource_group.lower())
-                except Exception as exc:
-                    sys.exit("Error: fetching virtual machines for resource group {0} - {1}".format(resource_group, str(exc)))
-                if self._args.host or self.tags:
-                    selected_machines = self._selected_machines(virtual_machines)
-                    self._load_machines(selected_machines)
-                else:
-                    self._load_machines(virtual_machines)
-        else:
-            # get all VMs within the subscription
             try:
-                virtual_machines = self._compute_client.virtual_machines.list_all()
+                virtual_machines = rm.compute_client.virtual_machines.list(resource_group)
             except Exception as exc:
-                sys.exit("Error: fetching virtual machines - {0}".format(str(exc)))
+                sys.exit("Error: fetching virtual machines for resource group {0} - {1}".format(resource_group, str(exc)))
+            virtual_machines = self._checked_pages(virtual_machines,
+                                                   "virtual machines for resource group {0}".format(resource_group))
+            if self.tags:
+                return self._selected_machines(virtual_machines)
+            return virtual_machines
+
+        # get all VMs within the subscription
+        try:
+            virtual_machines = rm.compute_client.virtual_machines.list_all()
+        except Exception as exc:
+            sys.exit("Error: fetching virtual machines - {0}".format(str(exc)))
 
-            if self._args.host or self.tags or self.locations:
-                selected_machines = self._selected_machines(virtual_machines)
-                self._load_machines(selected_machines)
-            else:
-                self._load_machines(virtual_machines)
+        virtual_machines = self._checked_pages(virtual_machines, "virtual machines")
+        if self.tags or self.locations:
+            return self._selected_machines(virtual_machines)
+        return virtual_machines
+
+    def _checked_pages(self, items, what):
+        ''' Iterate a pager, reporting the failure of a later page like the failure of the first one '''
+        try:
+            for item in items:
+                yield item
+        except Exception as exc:
+            sys.exit("Error: fetching {0} - {1}".format(what, str(exc)))
+
+    def _get_host_machines(self, name):
+        ''' Fetch the machines called name, without listing every machine of the subscription '''
+        scopes = []
+        for rm in self._rms:
+            if len(self.resource_groups) > 0:
+                scopes.extend((rm, resource_group.lower()) for resource_group in self.resource_groups)
+                continue
+            try:
+                resources = rm.rm_client.resources.list(
+                    filter="resourceType eq 'Microsoft.Compute/virtualMachines' and name eq '{0}'".format(name))
+                scopes.extend((rm, self._parse_ref_id(resource.id)['resourceGroups'].lower()) for resource in resources)
+            except Exception as exc:
+                sys.exit("Error: looking up virtual machine {0} - {1}".format(name, str(exc)))
+
+        machines = []
+        for rm, resource_group in scopes:
+            try:
+                machine = rm.compute_client.virtual_machines.get(resource_group, name)
+            except Exception as exc:
+                if getattr(exc, 'status_code', None) == 404:
+                    continue
+                sys.exit("Error: fetching virtual machine {0} in resource group {1} - {2}".format(name,
+                                                                                               resource_group,
+                                                                                               str(exc)))
+            if self.tags and not self._tags_match(machine.tags, self.tags):
+                continue
+            if self.locations and machine.location not in self.locations:
+                continue
+            machines.append(machine)
+        return machines
+
+    def _query_resource_graph(self, host=None):
+        ''' List the selected machines with one Resource Graph query. The network interfaces, public IPs,
+            security groups and power states it also returns fill the mappings the sdk backend prefetches,
+            so host vars are then built the same way. '''
+        self._network_interfaces = dict()
+        self._public_ip_addresses = dict()
+        self._powerstates = dict()
+        machines = []
+        try:
+            for row in self._rms[0].query_resource_graph(self._resource_graph_query(host)):
+                record = ResourceGraphRecord(row)
+                if record.type == 'Microsoft.Compute/virtualMachines':
+                    machines.append(record)
+                    if record.extended and record.extended.instance_view and \
+                       record.extended.instance_view.power_state:
+                        self._powerstates[record.id.lower()] = \
+                            record.extended.instance_view.power_state.code.replace('PowerState/', '')
+                elif record.type == 'Microsoft.Network/networkInterfaces':
+                    self._network_interfaces[record.id.lower()] = record
+                    if record.network_security_group:
+                        self._security_groups[record.id.lower()] = dict(
+                            name=record.network_security_group.id.rstrip('/').split('/')[-1],
+                            id=record.network_security_group.id
+                        )
+                elif record.type == 'Microsoft.Network/publicIPAddresses':
+                    self._public_ip_addresses[record.id.lower()] = record
+        except Exception as exc:
+            sys.exit("Error: querying Azure Resource Graph - {0}".format(str(exc)))
+
+        for rm in self._rms:
+            self._security_groups_loaded.add((rm.subscription_id, None))
+        return machines
+
+    def _resource_graph_query(self, host=None):
+        ''' The KQL query returning the selected machines, the network interfaces attached to them and the
+            public IPs of those network interfaces '''
+        machines = "Resources | where type =~ 'microsoft.compute/virtualmachines'"
+        for condition in self._resource_graph_conditions(host):
+            machines += ' | where {0}'.format(condition)
+        interfaces = ("Resources | where type =~ 'microsoft.network/networkinterfaces'"
+                      " | extend machineId = tolower(tostring(properties.virtualMachine.id))"
+                      " | join kind=inner ({0} | project machineId = tolower(id)) on machineId").format(machines)
+        addresses = ("Resources | where type =~ 'microsoft.network/publicipaddresses'"
+                     " | extend interfaceId = extract('^(.*/networkinterfaces/[^/]*)/', 1,"
+                     " tolower(tostring(properties.ipConfiguration.id)))"
+                     " | join kind=inner ({0} | project interfaceId = tolower(id)) on interfaceId").format(interfaces)
+        if self._skip_public_ips():
+            return ("{0} | union ({1})"
+                    " | project id, name, type, location, tags, plan, properties"
+                    " | order by id asc").format(machines, interfaces)
+        return ("{0} | union ({1}), ({2})"
+                " | project id, name, type, location, tags, plan, properties"
+                " | order by id asc").format(machines, interfaces, addresses)
+
+    def _resource_graph_conditions(self, host=None):
+        ''' The filters of _list_machines, or of _get_host_machines for a specific host, as KQL conditions '''
+        conditions = []
+        if host:
+            conditions.append('name == {0}'.format(self._kql_string(host)))
+        if len(self.resource_groups) > 0:
+            conditions.append('resourceGroup in~ ({0})'.format(
+                ', '.join(self._kql_string(resource_group) for resource_group in self.resource_groups)))
+
+        tags = None
+        if self.tags:
+            tags = ' and '.join(self._kql_tag_condition(tag) for tag in self.tags)
+        locations = None
+        if self.locations:
+            locations = 'location in ({0})'.format(', '.join(self._kql_string(location) for location in self.locations))
+
+        if host:
+            conditions.extend(condition for condition in (tags, locations) if condition)
+        elif len(self.resource_groups) > 0:
+            # Machines listed by resource group are only filtered on tags
+            if tags:
+                conditions.append(tags)
+        elif tags and locations:
+            conditions.append('({0}) or ({1})'.format(tags, locations))
+        elif tags or locations:
+            conditions.append(tags or locations)
+        return conditions
+
+    def _kql_tag_condition(self, tag):
+        ''' The KQL counterpart of one tag argument of _tags_match '''
+        key, _, value = tag.partition(':')
+        if value:
+            return 'tostring(tags[{0}]) == {1}'.format(self._kql_string(key), self._kql_string(value))
+        return 'isnotnull(tags[{0}])'.format(self._kql_string(key))
+
+    def _kql_string(self, value):
+        return "'{0}'".format(value.replace('\\', '\\\\').replace("'", "\\'"))
+
+    def _map(self, func, items):
+        ''' Apply func to each item, on the worker pool when one is configured. Results keep the order of items. '''
+        if self._executor is None:
+            return map(func, items)
+        return self._bounded_map(func, items)
+
+    def _bounded_map(self, func, items):
+        ''' Unlike executor.map, which reads all the items before returning, only submit up to 4 items per
+            worker ahead of the results consumed, so items are streamed through the pool '''
+        pending = collections.deque()
+        for item in items:
+            pending.append(self._executor.submit(func, item))
+            if len(pending) >= self.workers * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
     def _load_machines(self, machines):
+        for host_vars in self._map(self._get_host_vars, self._prepare_machines(machines)):
+            self._add_host(host_vars)
+
+    def _prepare_machines(self, machines):
+        ''' Load the security groups of each machine resource group before the machine is handed to a worker,
+            so the mapping is only ever written from this thread '''
         for machine in machines:
-            id_dict = azure_id_to_dict(machine.id)
-
-            # TODO - The API is returning an ID value containing resource group name in ALL CAPS. If/when it gets
-            #       fixed, we should remove the .lower(). Opened Issue
-            #       #574: https://github.com/Azure/azure-sdk-for-python/issues/574
-            resource_group = id_dict['resourceGroups'].lower()
-
-            if self.group_by_security_group:
-                self._get_security_groups(resource_group)
-
-            host_vars = dict(
-                ansible_host=None,
-                private_ip=None,
-                private_ip_alloc_method=None,
-                public_ip=None,
-                public_ip_name=None,
-                public_ip_id=None,
-                public_ip_alloc_method=None,
-                fqdn=None,
-                location=machine.location,
-                name=machine.name,
-                type=machine.type,
-                id=machine.id,
-                tags=machine.tags,
-                network_interface_id=None,
-                network_interface=None,
-                resource_group=resource_group,
-                mac_address=None,
-                plan=(machine.plan.name if machine.plan else None),
-                virtual_machine_size=machine.hardware_profile.vm_size,
-                computer_name=(machine.os_profile.computer_name if machine.os_profile else None),
-                provisioning_state=machine.provisioning_state,
-            )
+            if self.group_by_security_group and self._snapshot_host_vars(machine) is None:
+                self._get_security_groups(self._subscription_rm(machine.id), self._machine_resource_group(machine))
+            elif self._skip_security_groups and self._snapshot_host_vars(machine) is None:
+                self._skip_security_groups_listing(self._subscription_rm(machine.id),
+                                                   self._machine_resource_group(machine))
+            yield machine
+
+    def _skip_security_groups_listing(self, rm, resource_group):
+        ''' Count the security groups listing minimal mode avoids for resource_group '''
+        if (rm.subscription_id, None) in self._security_groups_loaded:
+            return
+        if (rm.subscription_id, resource_group) not in self._security_groups_loaded:
+            self._security_groups_loaded.add((rm.subscription_id, resource_group))
+            with self._counters_lock:
+                self._avoided_calls += 1
+
+    def _skip_public_ips(self):
+        ''' Public IPs are only needed to connect to hosts when private IPs are not used '''
+        return self.minimal and self.use_private_ip
+
+    def _machine_resource_group(self, machine):
+        id_dict = azure_id_to_dict(machine.id)
+
+        # TODO - The API is returning an ID value containing resource group name in ALL CAPS. If/when it gets
+        #       fixed, we should remove the .lower(). Opened Issue
+        #       #574: https://github.com/Azure/azure-sdk-for-python/issues/574
+        return id_dict['resourceGroups'].lower()
+
+    def _machine_fingerprint(self, machine):
+        ''' What an incremental refresh compares to decide whether a machine must be resolved again '''
+        return [machine.provisioning_state] + \
+            sorted(interface.id.lower() for interface in machine.network_profile.network_interfaces)
+
+    def _snapshot_host_vars(self, machine):
+        ''' Return the cached host vars of machine if it did not change since the snapshot, else None '''
+        if self._snapshot is None:
+            return None
+        entry = self._snapshot.get(machine.id.lower())
+        if entry is None or entry['fingerprint'] != self._machine_fingerprint(machine):
+            return None
+        return entry['host_vars']
+
+    def _get_host_vars(self, machine):
+        resource_group = self._machine_resource_group(machine)
+        previous = self._snapshot_host_vars(machine)
+        self._fingerprints[machine.id.lower()] = self._machine_fingerprint(machine)
+        if previous is None:
+            with self._counters_lock:
+                self._resolved_hosts += 1
+
+        host_vars = dict(
+            ansible_host=None,
+            private_ip=None,
+            private_ip_alloc_method=None,
+            public_ip=None,
+            public_ip_name=None,
+            public_ip_id=None,
+            public_ip_alloc_method=None,
+            fqdn=None,
+            location=machine.location,
+            name=machine.name,
+            type=machine.type,
+            id=machine.id,
+            tags=machine.tags,
+            network_interface_id=None,
+            network_interface=None,
+            resource_group=resource_group,
+            mac_address=None,
+            plan=(machine.plan.name if machine.plan else None),
+            virtual_machine_size=machine.hardware_profile.vm_size,
+            computer_name=(machine.os_profile.computer_name if machine.os_profile else None),
+            provisioning_state=machine.provisioning_state,
+        )
 
-            host_vars['os_disk'] = dict(
-                name=machine.storage_profile.os_disk.name,
-                operating_system_type=machine.storage_profile.os_disk.os_type.value.lower()
-            )
+        host_vars['os_disk'] = dict(
+            name=machine.storage_profile.os_disk.name,
+            operating_system_type=machine.storage_profile.os_disk.os_type.value.lower()
+        )
 
-            if self.include_powerstate:
-                host_vars['powerstate'] = self._get_powerstate(resource_group, machine.name)
-
-            if machine.storage_profile.image_reference:
-                host_vars['image'] = dict(
-                    offer=machine.storage_profile.image_reference.offer,
-                    publisher=machine.storage_profile.image_reference.publisher,
-                    sku=machine.storage_profile.image_reference.sku,
-                    version=machine.storage_profile.image_reference.version
-                )
-
-            # Add windows details
-            if machine.os_profile is not None and machine.os_profile.windows_configuration is not None:
-                host_vars['ansible_connection'] = 'winrm'
-                host_vars['windows_auto_updates_enabled'] = \
-                    machine.os_profile.windows_configuration.enable_automatic_updates
-                host_vars['windows_timezone'] = machine.os_profile.windows_configuration.time_zone
-                host_vars['windows_rm'] = None
-                if machine.os_profile.windows_configuration.win_rm is not None:
-                    host_vars['windows_rm'] = dict(listeners=None)
-                    if machine.os_profile.windows_configuration.win_rm.listeners is not None:
-                        host_vars['windows_rm']['listeners'] = []
-                        for listener in machine.os_profile.windows_configuration.win_rm.listeners:
-                            host_vars['windows_rm']['listeners'].append(dict(protocol=listener.protocol.name,
-                                                                             certificate_url=listener.certificate_url))
-
-            for interface in machine.network_profile.network_interfaces:
-                interface_reference = self._parse_ref_id(interface.id)
-                network_interface = self._network_client.network_interfaces.get(
-                    interface_reference['resourceGroups'],
-                    interface_reference['networkInterfaces'])
-                if network_interface.primary:
-                    if self.group_by_security_group and \
-                       self._security_groups[resource_group].get(network_interface.id, None):
-                        host_vars['security_group'] = \
-                            self._security_groups[resource_group][network_interface.id]['name']
-                        host_vars['security_group_id'] = \
-                            self._security_groups[resource_group][network_interface.id]['id']
-                    host_vars['network_interface'] = network_interface.name
-                    host_vars['network_interface_id'] = network_interface.id
-                    host_vars['mac_address'] = network_interface.mac_address
-                    for ip_config in network_interface.ip_configurations:
-                        host_vars['private_ip'] = ip_config.private_ip_address
-                        host_vars['private_ip_alloc_method'] = ip_config.private_ip_allocation_method
-                        if self.use_private_ip:
-                            host_vars['ansible_host'] = ip_config.private_ip_address
-                        if ip_config.public_ip_address:
-                            public_ip_reference = self._parse_ref_id(ip_config.public_ip_address.id)
-                            public_ip_address = self._network_client.public_ip_addresses.get(
-                                public_ip_reference['resourceGroups'],
-                                public_ip_reference['publicIPAddresses'])
-                            if not self.use_private_ip:
-                                host_vars['ansible_host'] = public_ip_address.ip_address
-                            host_vars['public_ip'] = public_ip_address.ip_address
-                            host_vars['public_ip_name'] = public_ip_address.name
-                            host_vars['public_ip_alloc_method'] = public_ip_address.public_ip_allocation_method
-                            host_vars['public_ip_id'] = public_ip_address.id
-                            if public_ip_address.dns_settings:
-                                host_vars['fqdn'] = public_ip_address.dns_settings.fqdn
+        if self.include_powerstate:
+            if previous is not None and self._powerstates is None:
+                host_vars['powerstate'] = previous.get('powerstate')
+            else:
+                host_vars['powerstate'] = self._get_powerstate(resource_group, machine.name, machine.id)
+        elif self._skip_powerstate and previous is None and not self._lists_powerstates():
+            with self._counters_lock:
+                self._avoided_calls += 1
+
+        if not self.minimal and machine.storage_profile.image_reference:
+            host_vars['image'] = dict(
+                offer=machine.storage_profile.image_reference.offer,
+                publisher=machine.storage_profile.image_reference.publisher,
+                sku=machine.storage_profile.image_reference.sku,
+                version=machine.storage_profile.image_reference.version
+            )
 
-            self._add_host(host_vars)
+        # Add windows details
+        if machine.os_profile is not None and machine.os_profile.windows_configuration is not None:
+            host_vars['ansible_connection'] = 'winrm'
+        if not self.minimal and machine.os_profile is not None and \
+           machine.os_profile.windows_configuration is not None:
+            host_vars['windows_auto_updates_enabled'] = \
+                machine.os_profile.windows_configuration.enable_automatic_updates
+            host_vars['windows_timezone'] = machine.os_profile.windows_configuration.time_zone
+            host_vars['windows_rm'] = None
+            if machine.os_profile.windows_configuration.win_rm is not None:
+                host_vars['windows_rm'] = dict(listeners=None)
+                if machine.os_profile.windows_configuration.win_rm.listeners is not None:
+                    host_vars['windows_rm']['listeners'] = []
+                    for listener in machine.os_profile.windows_configuration.win_rm.listeners:
+                        host_vars['windows_rm']['listeners'].append(dict(protocol=listener.protocol.name,
+                                                                         certificate_url=listener.certificate_url))
+
+        if previous is not None:
+            for key in AZURE_RESOLVED_HOST_VARS:
+                if key in previous:
+                    host_vars[key] = previous[key]
+            return self._shared_host_vars(host_vars)
+
+        for interface in machine.network_profile.network_interfaces:
+            network_interface = self._get_network_interface(interface.id)
+            if network_interface.primary:
+                if self.group_by_security_group and \
+                   self._security_groups.get(network_interface.id.lower(), None):
+                    host_vars['security_group'] = \
+                        self._security_groups[network_interface.id.lower()]['name']
+                    host_vars['security_group_id'] = \
+                        self._security_groups[network_interface.id.lower()]['id']
+                host_vars['network_interface'] = network_interface.name
+                host_vars['network_interface_id'] = network_interface.id
+                host_vars['mac_address'] = network_interface.mac_address
+                for ip_config in network_interface.ip_configurations:
+                    host_vars['private_ip'] = ip_config.private_ip_address
+                    host_vars['private_ip_alloc_method'] = ip_config.private_ip_allocation_method
+                    if self.use_private_ip:
+                        host_vars['ansible_host'] = ip_config.private_ip_address
+                    if ip_config.public_ip_address and self._skip_public_ips():
+                        if self._public_ip_addresses is None:
+                            with self._counters_lock:
+                                self._avoided_calls += 1
+                    elif ip_config.public_ip_address:
+                        public_ip_address = self._get_public_ip_address(ip_config.public_ip_address.id)
+                        if not self.use_private_ip:
+                            host_vars['ansible_host'] = public_ip_address.ip_address
+                        host_vars['public_ip'] = public_ip_address.ip_address
+                        host_vars['public_ip_name'] = public_ip_address.name
+                        host_vars['public_ip_alloc_method'] = public_ip_address.public_ip_allocation_method
+                        host_vars['public_ip_id'] = public_ip_address.id
+                        if public_ip_address.dns_settings:
+                            host_vars['fqdn'] = public_ip_address.dns_settings.fqdn
+
+        return self._shared_host_vars(host_vars)
+
+    def _shared_host_vars(self, host_vars):
+        ''' Replace the values repeated across hosts by a single instance of each: strings are interned, and
+            hosts with the same tags, image or OS disk type share the same dict '''
+        for key in AZURE_SHARED_HOST_VARS:
+            if isinstance(host_vars.get(key), str):
+                host_vars[key] = sys.intern(host_vars[key])
+        host_vars['os_disk']['operating_system_type'] = sys.intern(host_vars['os_disk']['operating_system_type'])
+        if host_vars.get('tags'):
+            host_vars['tags'] = self._shared_value(host_vars['tags'])
+        if host_vars.get('image'):
+            host_vars['image'] = self._shared_value(host_vars['image'])
+        return host_vars
+
+    def _shared_value(self, value):
+        ''' Return the first dict seen with the same items as value, in the same order '''
+        key = tuple(value.items())
+        try:
+            return self._shared_values.setdefault(key, value)
+        except TypeError:
+            # Unhashable items
+            return value
 
     def _selected_machines(self, virtual_machines):
-        selected_machines = []
         for machine in virtual_machines:
-            if self._args.host and self._args.host == machine.name:
-                selected_machines.append(machine)
             if self.tags and self._tags_match(machine.tags, self.tags):
-                selected_machines.append(machine)
+                yield machine
             if self.locations and machine.location in self.locations:
-                selected_machines.append(machine)
-        return selected_machines
-
-    def _get_security_groups(self, resource_group):
+                yield machine
+
+    def _prefetch_network(self):
+        ''' Build mappings of network_interface.id and public_ip_address.id to their records '''
+        self._network_interfaces = dict()
+        self._public_ip_addresses = dict()
+        for interfaces, addresses in self._map(self._list_network, self._scopes()):
+            for interface in interfaces:
+                self._network_interfaces[interface.id.lower()] = interface
+            for address in addresses:
+                self._public_ip_addresses[address.id.lower()] = address
+
+    def _list_network(self, scope):
+        rm, resource_group = scope
+        try:
+            if resource_group:
+                interfaces = rm.network_client.network_interfaces.list(resource_group)
+            else:
+                interfaces = rm.network_client.network_interfaces.list_all()
+            if self._skip_public_ips():
+                with self._counters_lock:
+                    self._avoided_calls += 1
+                return list(interfaces), []
+            if resource_group:
+                return list(interfaces), list(rm.network_client.public_ip_addresses.list(resource_group))
+            return list(interfaces), list(rm.network_client.public_ip_addresses.list_all())
+        except Exception as exc:
+            sys.exit("Error: listing network interfaces and public IPs - {0}".format(str(exc)))
+
+    def _get_network_interface(self, interface_id):
+        if self._network_interfaces is not None and interface_id.lower() in self._network_interfaces:
+            return self._network_interfaces[interface_id.lower()]
+        interface_reference = self._parse_ref_id(interface_id)
+        network_client = self._subscription_rm(interface_id).network_client
+        return network_client.network_interfaces.get(interface_reference['resourceGroups'],
+                                                     interface_reference['networkInterfaces'])
+
+    def _get_public_ip_address(self, public_ip_id):
+        if self._public_ip_addresses is not None and public_ip_id.lower() in self._public_ip_addresses:
+            return self._public_ip_addresses[public_ip_id.lower()]
+        public_ip_reference = self._parse_ref_id(public_ip_id)
+        network_client = self._subscription_rm(public_ip_id).network_client
+        return network_client.public_ip_addresses.get(public_ip_reference['resourceGroups'],
+                                                      public_ip_reference['publicIPAddresses'])
+
+    def _subscription_rm(self, resource_id):
+        ''' The AzureRM whose clients are bound to the subscription of resource_id '''
+        subscription_id = self._parse_ref_id(resource_id).get('subscriptions', '').lower()
+        return self._rms_by_subscription.get(subscription_id, self._rms[0])
+
+    def _get_security_groups(self, rm, resource_group):
         ''' For a given resource_group build a mapping of network_interface.id to security_group name '''
-        if not self._security_groups:
-            self._security_groups = dict()
-        if not self._security_groups.get(resource_group):
-            self._security_groups[resource_group] = dict()
-            for group in self._network_client.network_security_groups.list(resource_group):
-                if group.network_interfaces:
-                    for interface in group.network_interfaces:
-                        self._security_groups[resource_group][interface.id] = dict(
-                            name=group.name,
-                            id=group.id
-                        )
+        # A None resource group marks a subscription whose security groups were all listed at once
+        if (rm.subscription_id, None) in self._security_groups_loaded:
+            return
+        if (rm.subscription_id, resource_group) not in self._security_groups_loaded:
+            self._security_groups_loaded.add((rm.subscription_id, resource_group))
+            try:
+                self._add_security_groups(rm.network_client.network_security_groups.list(resource_group))
+            except Exception as exc:
+                sys.exit("Error: listing network security groups for resource group {0} - {1}".format(resource_group,
+                                                                                                     str(exc)))
+
+    def _prefetch_security_groups(self):
+        ''' Build the mapping of network_interface.id to security group from one listing of each subscription '''
+        for rm, groups in zip(self._rms, self._map(self._list_security_groups, self._rms)):
+            self._add_security_groups(groups)
+            self._security_groups_loaded.add((rm.subscription_id, None))
+
+    def _list_security_groups(self, rm):
+        try:
+            return list(rm.network_client.network_security_groups.list_all())
+        except Exception as exc:
+            sys.exit("Error: listing network security groups - {0}".format(str(exc)))
+
+    def _add_security_groups(self, groups):
+        for group in groups:
+            if group.network_interfaces:
+                for interface in group.network_interfaces:
+                    self._security_groups[interface.id.lower()] = dict(
+                        name=group.name,
+                        id=group.id
+                    )
+
+    def _lists_powerstates(self):
+        ''' Whether power states come from listing the statuses of each subscription: with bulk powerstate, and
+            on incremental refreshes, where the snapshot cannot tell whether a machine was stopped since '''
+        return self.bulk_powerstate or self._snapshot is not None
+
+    def _prefetch_powerstates(self):
+        ''' Build a mapping of virtual_machine.id to power state from a single listing of each subscription '''
+        for powerstates in self._map(self._list_powerstates, self._rms):
+            if powerstates is not None:
+                if self._powerstates is None:
+                    self._powerstates = dict()
+                self._powerstates.update(powerstates)
+
+    def _list_powerstates(self, rm):
+        # The status client serves this listing only, so its responses are the pages the listing fetched
+        requests = [0]
+
+        def count_requests(response, *args, **kwargs):
+            history = getattr(getattr(getattr(response, 'raw', None), 'retries', None), 'history', None) or ()
+            with self._counters_lock:
+                requests[0] += 1 + len(history)
+
+        client = rm.compute_status_client
+        hooks = getattr(getattr(client, 'config', None), 'hooks', None)
+        if isinstance(hooks, list):
+            hooks.append(count_requests)
+        try:
+            powerstates = dict()
+            for machine in client.virtual_machines.list_all(status_only='true'):
+                if machine.instance_view:
+                    powerstates[machine.id.lower()] = self._powerstate(machine.instance_view.statuses)
+            return powerstates
+        except Exception as exc:
+            # Older SDKs do not know statusOnly, hosts then fall back to one instance view call each
+            rm.log("Bulk powerstate listing failed - {0}".format(str(exc)))
+            return None
+        finally:
+            if isinstance(hooks, list):
+                hooks.remove(count_requests)
+            with self._counters_lock:
+                # Without response hooks, a listing costs at least one request
+                self._powerstate_requests += max(requests[0], 1)
+
+    def _get_powerstate(self, resource_group, name, vm_id):
+        if self._powerstates is not None and vm_id.lower() in self._powerstates:
+            with self._counters_lock:
+                self._powerstate_hits += 1
+            return self._powerstates[vm_id.lower()]
 
-    def _get_powerstate(self, resource_group, name):
         try:
-            vm = self._compute_client.virtual_machines.get(resource_group,
-                                                           name,
-                                                           expand='instanceview')
+            vm = self._subscription_rm(vm_id).compute_client.virtual_machines.get(resource_group,
+                                                                                  name,
+                                                                                  expand='instanceview')
         except Exception as exc:
             sys.exit("Error: fetching instanceview for host {0} - {1}".format(name, str(exc)))
 
+        return self._powerstate(vm.instance_view.statuses)
+
+    def _powerstate(self, statuses):
         return next((s.code.replace('PowerState/', '')
-                     for s in vm.instance_view.statuses if s.code.startswith('PowerState')), None)
+                     for s in statuses if s.code.startswith('PowerState')), None)
+
+    def _reset_inventory(self):
+        # Groups are dicts used as insertion ordered sets of host names, written out as lists
+        self._inventory = dict(
+            _meta=dict(
+                hostvars=dict()
+            ),
+            azure=dict()
+        )
+        self._hosts = []
+        self._safe_words = dict()
+        self._tag_groups = dict()
 
     def _add_host(self, vars):
 
         host_name = self._to_safe(vars['name'])
-        resource_group = self._to_safe(vars['resource_group'])
-        operating_system_type = self._to_safe(vars['os_disk']['operating_system_type'].lower())
-        security_group = None
-        if vars.get('security_group'):
-            security_group = self._to_safe(vars['security_group'])
+        hostvars = self._inventory['_meta']['hostvars']
+        if host_name in hostvars:
+            if hostvars[host_name]['id'].lower() != vars['id'].lower():
+                sys.stderr.write("azure_rm: skipping {0}, host name {1} is already used by {2}\n".format(
+                    vars['id'], host_name, hostvars[host_name]['id']))
+            return
 
         if self.group_by_os_family:
-            if not self._inventory.get(operating_system_type):
-                self._inventory[operating_system_type] = []
-            self._inventory[operating_system_type].append(host_name)
+            self._add_to_group(self._to_safe(vars['os_disk']['operating_system_type'].lower()), host_name)
 
         if self.group_by_resource_group:
-            if not self._inventory.get(resource_group):
-                self._inventory[resource_group] = []
-            self._inventory[resource_group].append(host_name)
+            self._add_to_group(self._to_safe(vars['resource_group']), host_name)
 
         if self.group_by_location:
-            if not self._inventory.get(vars['location']):
-                self._inventory[vars['location']] = []
-            self._inventory[vars['location']].append(host_name)
+            self._add_to_group(vars['location'], host_name)
 
-        if self.group_by_security_group and security_group:
-            if not self._inventory.get(security_group):
-                self._inventory[security_group] = []
-            self._inventory[security_group].append(host_name)
+        if self.group_by_security_group and vars.get('security_group'):
+            self._add_to_group(self._to_safe(vars['security_group']), host_name)
 
-        self._inventory['_meta']['hostvars'][host_name] = vars
-        self._inventory['azure'].append(host_name)
+        hostvars[host_name] = vars
+        self._hosts.append(vars)
+        self._add_to_group('azure', host_name)
 
         if self.group_by_tag and vars.get('tags'):
-            for key, value in vars['tags'].items():
-                safe_key = self._to_safe(key)
-                safe_value = safe_key + '_' + self._to_safe(value)
-                if not self._inventory.get(safe_key):
-                    self._inventory[safe_key] = []
-                if not self._inventory.get(safe_value):
-                    self._inventory[safe_value] = []
-                self._inventory[safe_key].append(host_name)
-                self._inventory[safe_value].append(host_name)
-
-    def _json_format_dict(self, pretty=False):
-        # convert inventory to json
+            for tag in vars['tags'].items():
+                groups = self._tag_groups.get(tag)
+                if groups is None:
+                    safe_key = self._to_safe(tag[0])
+                    groups = self._tag_groups[tag] = (safe_key, safe_key + '_' + self._to_safe(tag[1]))
+                self._add_to_group(groups[0], host_name)
+                self._add_to_group(groups[1], host_name)
+
+    def _add_to_group(self, group, host_name):
+        members = self._inventory.get(group)
+        if members is None:
+            members = self._inventory[group] = dict()
+        members[host_name] = None
+
+    def _cache_subscription_id(self):
+        ''' Find the subscription the inventory is built for without authenticating, following the
+            precedence of AzureRM._get_credentials. Returns None when only the SDK can tell (MSI, Azure CLI). '''
+        if self._args.profile:
+            return self._profile_subscription_id(self._args.profile)
+        if self._args.subscription_id:
+            return self._args.subscription_id
+        if os.environ.get(AZURE_CREDENTIAL_ENV_MAPPING['profile']):
+            return self._profile_subscription_id(os.environ[AZURE_CREDENTIAL_ENV_MAPPING['profile']])
+        if os.environ.get(AZURE_CREDENTIAL_ENV_MAPPING['subscription_id']):
+            return os.environ[AZURE_CREDENTIAL_ENV_MAPPING['subscription_id']]
+        return self._profile_subscription_id('default')
+
+    def _profile_subscription_id(self, profile):
+        config = cp.ConfigParser()
+        config.read(os.path.join(expanduser("~"), '.azure', 'credentials'))
+        try:
+            return config.get(profile, 'subscription_id', raw=True)
+        except Exception:
+            return None
+
+    def _cache_file(self, subscription_id):
+        ''' The cache file name is derived from everything that changes which hosts are listed and their hostvars '''
+        key = json.dumps(dict(
+            subscription_id=','.join(subscription.strip() for subscription in subscription_id.split(',')),
+            resource_groups=self.resource_groups,
+            tags=self.tags,
+            locations=self.locations,
+            include_powerstate=self.include_powerstate,
+            use_private_ip=self.use_private_ip,
+            minimal=self.minimal,
+        ), sort_keys=True)
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+        return os.path.join(os.path.expanduser(os.path.expandvars(self.cache_path)),
+                            'ansible-azure_rm-{0}.json'.format(digest))
+
+    def _read_cache(self, cache_file):
+        try:
+            with open(cache_file) as f:
+                cache = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if cache.get('version') != AZURE_CACHE_VERSION:
+            return None
+        return cache
+
+    def _load_cache(self, cache_file):
+        ''' Rebuild the inventory from cache_file if it is fresh enough. Returns True on a cache hit. '''
+        try:
+            if time.time() - os.path.getmtime(cache_file) > self.cache_max_age:
+                return False
+        except OSError:
+            return False
+        cache = self._read_cache(cache_file)
+        if cache is None:
+            return False
+
+        for host_vars in cache['hosts']:
+            if self._args.host and host_vars['name'] != self._args.host:
+                continue
+            self._add_host(host_vars)
+        return True
+
+    def _load_snapshot(self, cache_file):
+        ''' Index an expired cache by machine id, for an incremental refresh '''
+        cache = self._read_cache(cache_file)
+        if cache is None:
+            return
+        self._snapshot = dict()
+        for host_vars in cache['hosts']:
+            self._snapshot[host_vars['id'].lower()] = dict(
+                fingerprint=cache['fingerprints'].get(host_vars['id'].lower()),
+                host_vars=host_vars
+            )
+
+    def _write_cache(self, cache_file):
+        ''' Write the cache next to its final location then rename it, so that concurrent runs sharing the
+            cache directory only ever read a complete file '''
+        cache_dir = os.path.dirname(cache_file)
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            fd, tmp_file = tempfile.mkstemp(dir=cache_dir, prefix='.ansible-azure_rm-')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(dict(version=AZURE_CACHE_VERSION, hosts=self._hosts, fingerprints=self._fingerprints), f)
+            os.rename(tmp_file, cache_file)
+        except (IOError, OSError) as exc:
+            sys.stderr.write("azure_rm: unable to write inventory cache {0} - {1}\n".format(cache_file, str(exc)))
+
+    def _write_profile(self):
+        if self._profiler is None:
+            return
+        summary = self._profiler.summary()
+        if self._throttle is not None:
+            summary['throttle'] = self._throttle.summary()
+        summary = json.dumps(summary, sort_keys=True, indent=2)
+        if self.inventory_profile == '-':
+            sys.stderr.write(summary + '\n')
+            return
+        profile_file = os.path.expanduser(os.path.expandvars(self.inventory_profile))
+        try:
+            with open(profile_file, 'w') as f:
+                f.write(summary + '\n')
+        except (IOError, OSError) as exc:
+            sys.stderr.write("azure_rm: unable to write API profile {0} - {1}\n".format(profile_file, str(exc)))
+
+    def _write_inventory(self, out, pretty=False):
+        ''' Write the inventory as JSON, one host at a time rather than as a single string as large as the
+            whole inventory. The output is the same as json.dumps. '''
+        inventory = dict((group, members if group == '_meta' else list(members))
+                         for group, members in self._inventory.items())
         if pretty:
-            return json.dumps(self._inventory, sort_keys=True, indent=2)
+            for chunk in json.JSONEncoder(sort_keys=True, indent=2).iterencode(inventory):
+                out.write(chunk)
         else:
-            return json.dumps(self._inventory)
+            # Stream the inventory, _meta and hostvars dicts, dump each group and host at once
+            self._write_json(out, inventory, 3)
+        out.write('\n')
+
+    def _write_json(self, out, value, depth):
+        if depth == 0 or not isinstance(value, dict):
+            out.write(json.dumps(value))
+            return
+        out.write('{')
+        for index, (key, item) in enumerate(value.items()):
+            if index:
+                out.write(', ')
+            out.write(json.dumps(key))
+            out.write(': ')
+            self._write_json(out, item, depth - 1)
+        out.write('}')
 
     def _get_settings(self):
         # Load settings from the .ini, if it exists. Otherwise,
@@ -869,6 +2166,10 @@ class AzureInventory(object):
                     values = file_settings.get(key).split(',')
                     if len(values) > 0:
                         setattr(self, key, values)
+                elif key in AZURE_INTEGER_SETTINGS and file_settings.get(key):
+                    setattr(self, key, self._to_integer(key, file_settings[key]))
+                elif key in AZURE_STRING_SETTINGS and file_settings.get(key):
+                    setattr(self, key, file_settings[key])
                 elif file_settings.get(key):
                     val = self._to_boolean(file_settings[key])
                     setattr(self, key, val)
@@ -879,6 +2180,10 @@ class AzureInventory(object):
                     values = env_settings.get(key).split(',')
                     if len(values) > 0:
                         setattr(self, key, values)
+                elif key in AZURE_INTEGER_SETTINGS and env_settings.get(key):
+                    setattr(self, key, self._to_integer(key, env_settings[key]))
+                elif key in AZURE_STRING_SETTINGS and env_settings.get(key):
+                    setattr(self, key, env_settings[key])
                 elif env_settings.get(key, None) is not None:
                     val = self._to_boolean(env_settings[key])
                     setattr(self, key, val)
@@ -900,6 +2205,12 @@ class AzureInventory(object):
             result = True
         return result
 
+    def _to_integer(self, key, value):
+        try:
+            return int(value)
+        except ValueError:
+            sys.exit("Error: setting {0} expects an integer, got '{1}'".format(key, value))
+
     def _get_env_settings(self):
         env_settings = dict()
         for attribute, env_variable in AZURE_CONFIG_SETTINGS.items():
@@ -956,16 +2267,17 @@ class AzureInventory(object):
 
     def _to_safe(self, word):
         ''' Converts 'bad' characters in a string to underscores so they can be used as Ansible groups '''
-        regex = r"[^A-Za-z0-9\_"
-        if not self.replace_dash_in_groups:
-            regex += r"\-"
-        return re.sub(regex + "]", "_", word)
+        safe_word = self._safe_words.get(word)
+        if safe_word is None:
+            if self.replace_dash_in_groups:
+                safe_word = AZURE_UNSAFE_GROUP_CHARS.sub('_', word)
+            else:
+                safe_word = AZURE_UNSAFE_GROUP_CHARS_KEEP_DASH.sub('_', word)
+            self._safe_words[word] = safe_word
+        return safe_word
 
 
 def main():
-    if not HAS_AZURE:
-        sys.exit("The Azure python sdk is not installed (try `pip install 'azure>={0}' --upgrade`) - {1}".format(AZURE_MIN_VERSION, HAS_AZURE_EXC))
-
     AzureInventory()
 
 
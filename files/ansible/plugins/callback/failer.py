@@ -17,9 +17,29 @@ description: |+
   This callback module exits non-zero if\n
   - No hosts are matched\n
   - No hosts are reachable\n
-  - No step resulted in ["ok", "failure", "dark", "changed", "skipped"]
-
-options: null
+  - No step resulted in ["ok", "failure", "dark", "changed", "skipped"]\n
+  - More hosts were unreachable than max_unreachable, when it is set. Up to it, the playbook goes on with the
+    other hosts and only fails once it is over. Without it, unreachable hosts do not stop the playbook, whose
+    exit status is left to ansible-playbook. Either way the unreachable hosts are listed once it is over, so
+    that they can be retried with --limit.
+
+options:
+  max_unreachable:
+    description: |+
+      Number of unreachable hosts (or percentage of the hosts of the plays run so far, like 5%) tolerated
+      before failing right away. Unset, unreachable hosts are not limited.
+    env:
+    - name: ANSIBLE_FAILER_MAX_UNREACHABLE
+    ini:
+    - section: callback_failer
+      key: max_unreachable
+  unreachable_file:
+    description: File the unreachable hosts are written to, one per line, for --limit @file.
+    env:
+    - name: ANSIBLE_FAILER_UNREACHABLE_FILE
+    ini:
+    - section: callback_failer
+      key: unreachable_file
 """
 
 
@@ -32,6 +52,8 @@ class CallbackModule(CallbackBase):
 
     def __init__(self):
         super(CallbackModule, self).__init__()
+        self._hosts = set()
+        self._unreachable = []
 
     def playbook_on_no_hosts_matched(self):
         self.v2_playbook_on_no_hosts_matched()
@@ -40,11 +62,65 @@ class CallbackModule(CallbackBase):
         self.v2_playbook_on_stats(stats)
 
     def runner_on_unreachable(self, host, res):
-        self.v2_runner_on_unreachable()
-
-    def v2_runner_on_unreachable(self):
-        self._display.display("Failed due to host unreachable")
-        sys.exit(1)
+        self._host_unreachable(host)
+
+    def v2_playbook_on_play_start(self, play):
+        try:
+            hosts = play.get_variable_manager()._inventory.get_hosts(play.hosts)
+        except Exception:
+            return
+        self._hosts.update(host.get_name() for host in hosts)
+
+    def v2_runner_on_unreachable(self, result):
+        self._host_unreachable(result._host.get_name())
+
+    def _host_unreachable(self, host):
+        if host in self._unreachable:
+            return
+        self._unreachable.append(host)
+        self._hosts.add(host)
+        max_unreachable = self._max_unreachable()
+        if max_unreachable is None:
+            self._display.warning("Host %s is unreachable" % host)
+            return
+        if len(self._unreachable) > max_unreachable:
+            self._display.display("Failed due to host unreachable")
+            self._report_unreachable()
+            sys.exit(1)
+        self._display.warning(
+            "Host %s is unreachable, %d unreachable host(s) tolerated so far"
+            % (host, len(self._unreachable))
+        )
+
+    def _max_unreachable(self):
+        """ The number of unreachable hosts tolerated, None when they are not limited """
+        max_unreachable = self.get_option("max_unreachable")
+        if max_unreachable is None or str(max_unreachable).strip() == "":
+            return None
+        max_unreachable = str(max_unreachable).strip()
+        try:
+            if max_unreachable.endswith("%"):
+                return len(self._hosts) * float(max_unreachable[:-1]) / 100
+            return int(max_unreachable)
+        except ValueError:
+            self._display.warning(
+                "Invalid max_unreachable %s, no unreachable host is tolerated"
+                % max_unreachable
+            )
+            return 0
+
+    def _report_unreachable(self):
+        self._display.display("Unreachable hosts: %s" % ",".join(self._unreachable))
+        unreachable_file = self.get_option("unreachable_file")
+        if not unreachable_file:
+            return
+        try:
+            with open(unreachable_file, "w") as f:
+                f.write("".join(host + "\n" for host in self._unreachable))
+        except (IOError, OSError) as e:
+            self._display.warning(
+                "Could not write the unreachable hosts to %s: %s" % (unreachable_file, e)
+            )
 
     def v2_playbook_on_no_hosts_matched(self):
         self._display.display("Failed due to no host matching")
@@ -62,3 +138,14 @@ class CallbackModule(CallbackBase):
         if not found_stats:
             self._display.display("Failed due to no stats")
             sys.exit(1)
+
+        if self._unreachable:
+            if self._max_unreachable() is None:
+                # ansible-playbook exits with its own status for unreachable hosts
+                self._report_unreachable()
+                return
+            self._display.display(
+                "Failed due to %d unreachable host(s)" % len(self._unreachable)
+            )
+            self._report_unreachable()
+            sys.exit(1)
@@ -0,0 +1,173 @@
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import json
+import os
+import time
+
+from ansible.plugins.callback import CallbackBase
+
+DOCUMENTATION = """
+name: pipeline_profile
+callback_type: aggregate
+requirements:
+- enable in configuration
+short_description: Write the timings of a playbook run as a JSON artifact
+description: |+
+  This callback module records how long each play, task and host took, and writes them as JSON once the
+  playbook is over, so that runs can be compared and straggler hosts found. For each task it keeps\n
+  - The duration on every host, and the slowest hosts\n
+  - The time between the task start and the first host result\n
+  - The duration from the task start to the last host result
+
+options:
+  path:
+    description: File the JSON profile is written to.
+    default: ansible-pipeline-profile.json
+    env:
+    - name: ANSIBLE_PIPELINE_PROFILE
+    ini:
+    - section: callback_pipeline_profile
+      key: path
+  slowest_hosts:
+    description: Number of slowest hosts listed for each task.
+    default: 5
+    type: int
+    env:
+    - name: ANSIBLE_PIPELINE_PROFILE_SLOWEST_HOSTS
+    ini:
+    - section: callback_pipeline_profile
+      key: slowest_hosts
+"""
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = "aggregate"
+    CALLBACK_NAME = "pipeline_profile"
+    CALLBACK_NEEDS_WHITELIST = True
+    CALLBACK_NEEDS_ENABLED = True
+
+    def __init__(self):
+        super(CallbackModule, self).__init__()
+        self._playbook = None
+        self._started = time.time()
+        self._plays = []
+        self._tasks = []
+        self._play = None
+        self._task = None
+        # Per host start of the running task, from v2_runner_on_start when ansible sends it
+        self._host_started = {}
+
+    def v2_playbook_on_start(self, playbook):
+        self._playbook = os.path.basename(playbook._file_name)
+        self._started = time.time()
+
+    def v2_playbook_on_play_start(self, play):
+        now = time.time()
+        self._end_task(now)
+        self._end_play(now)
+        self._play = dict(name=play.get_name().strip(), started=now, duration=None, tasks=0)
+        self._plays.append(self._play)
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self._start_task(task, handler=False)
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self._start_task(task, handler=True)
+
+    def v2_runner_on_start(self, host, task):
+        self._host_started[host.get_name()] = time.time()
+
+    def v2_runner_on_ok(self, result):
+        self._host_result(result, "ok")
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._host_result(result, "failed")
+
+    def v2_runner_on_skipped(self, result):
+        self._host_result(result, "skipped")
+
+    def v2_runner_on_unreachable(self, result):
+        self._host_result(result, "unreachable")
+
+    def v2_playbook_on_stats(self, stats):
+        now = time.time()
+        self._end_task(now)
+        self._end_play(now)
+
+        hosts = {}
+        for task in self._tasks:
+            for host, result in task["hosts"].items():
+                profile = hosts.setdefault(host, dict(duration=0.0, tasks=0, status={}))
+                profile["duration"] = round(profile["duration"] + result["duration"], 3)
+                profile["tasks"] += 1
+                profile["status"][result["status"]] = profile["status"].get(result["status"], 0) + 1
+
+        profile = dict(
+            playbook=self._playbook,
+            started=self._started,
+            duration=round(now - self._started, 3),
+            plays=self._plays,
+            tasks=self._tasks,
+            hosts=hosts,
+            stats=dict((host, stats.summarize(host)) for host in sorted(stats.processed)),
+        )
+        path = self.get_option("path")
+        try:
+            with open(path, "w") as f:
+                json.dump(profile, f, indent=2, sort_keys=True)
+                f.write("\n")
+        except (IOError, OSError) as e:
+            self._display.warning("Could not write the pipeline profile to %s: %s" % (path, e))
+            return
+        self._display.display("Pipeline profile written to %s" % path)
+
+    def _start_task(self, task, handler):
+        now = time.time()
+        self._end_task(now)
+        self._host_started = {}
+        self._task = dict(
+            name=task.get_name().strip(),
+            action=task.action,
+            path=task.get_path(),
+            play=self._play["name"] if self._play else None,
+            handler=handler,
+            started=now,
+            duration=None,
+            first_result=None,
+            hosts={},
+            slowest_hosts=[],
+        )
+        self._tasks.append(self._task)
+        if self._play:
+            self._play["tasks"] += 1
+
+    def _host_result(self, result, status):
+        if self._task is None:
+            return
+        now = time.time()
+        host = result._host.get_name()
+        if self._task["first_result"] is None:
+            self._task["first_result"] = round(now - self._task["started"], 3)
+        started = self._host_started.pop(host, self._task["started"])
+        self._task["hosts"][host] = dict(status=status, duration=round(now - started, 3))
+        self._task["duration"] = round(now - self._task["started"], 3)
+
+    def _end_task(self, now):
+        if self._task is None:
+            return
+        if self._task["duration"] is None:
+            self._task["duration"] = round(now - self._task["started"], 3)
+        slowest = sorted(self._task["hosts"].items(), key=lambda item: item[1]["duration"], reverse=True)
+        self._task["slowest_hosts"] = [
+            dict(host=host, duration=result["duration"]) for host, result in slowest[: self.get_option("slowest_hosts")]
+        ]
+        self._task = None
+
+    def _end_play(self, now):
+        if self._play is None:
+            return
+        self._play["duration"] = round(now - self._play["started"], 3)
+        self._play = None
@@ -0,0 +1,217 @@
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import json
+
+from ansible.plugins.callback.default import CallbackModule as DefaultCallbackModule
+
+DOCUMENTATION = """
+name: trim_results
+type: stdout
+requirements:
+- set as stdout in configuration
+short_description: Default ansible output with oversized results trimmed
+description: |+
+  This callback module displays results like the default one, after cutting down the results bigger than a byte
+  budget, so that the log volume stays bounded on large fleets with --diff. The biggest fields (stdout, diff,
+  loop results, module return payloads) are trimmed first, the small ones like changed, rc or msg are kept.
+  Only the displayed and logged results are trimmed: the results ansible keeps in memory, for registered
+  variables, handlers and the play recap, are untouched, and so is the memory used by the controller.\n
+  - Each result is cut down to max_result_bytes of JSON\n
+  - Once a host displayed max_host_bytes, its next results are cut down to 1KiB\n
+  - The full results trimmed can be written to an NDJSON file, one result per line
+extends_documentation_fragment:
+- default_callback
+- result_format_callback
+
+options:
+  max_result_bytes:
+    description: Size of JSON each result is cut down to, 0 to disable.
+    default: 65536
+    type: int
+    env:
+    - name: ANSIBLE_TRIM_RESULT_BYTES
+    ini:
+    - section: callback_trim_results
+      key: max_result_bytes
+  max_host_bytes:
+    description: Size of JSON displayed for a host before its next results are cut down to 1KiB, 0 to disable.
+    default: 1048576
+    type: int
+    env:
+    - name: ANSIBLE_TRIM_HOST_BYTES
+    ini:
+    - section: callback_trim_results
+      key: max_host_bytes
+  spill_path:
+    description: NDJSON file the full results trimmed are appended to.
+    env:
+    - name: ANSIBLE_TRIM_SPILL_PATH
+    ini:
+    - section: callback_trim_results
+      key: spill_path
+"""
+
+# Budget of a result once its host is over max_host_bytes
+MIN_RESULT_BYTES = 1024
+# Below it, the rest of a list is dropped rather than its first item trimmed
+MIN_ITEM_BYTES = 64
+
+
+def _size(value):
+    return len(json.dumps(value, default=str))
+
+
+def _trimmed(value, budget):
+    """ Return a copy of value cut down to about budget bytes of JSON, and its size """
+    size = _size(value)
+    if size <= budget:
+        return value, size
+
+    if isinstance(value, dict):
+        # The smallest fields are kept whole, what they leave of the budget is shared by the bigger ones
+        sizes = dict((key, _size(item)) for key, item in value.items())
+        trimmed = {}
+        used = 0
+        keys = sorted(value, key=sizes.get)
+        for index, key in enumerate(keys):
+            share = max(budget - used, 0) // (len(keys) - index)
+            if sizes[key] <= share:
+                trimmed[key] = value[key]
+                used += sizes[key]
+            else:
+                trimmed[key], item_size = _trimmed(value[key], share)
+                used += item_size
+        return dict((key, trimmed[key]) for key in value), used
+
+    if isinstance(value, (list, tuple)):
+        kept = []
+        used = 0
+        for item in value:
+            item_size = _size(item)
+            if used + item_size > budget:
+                # The first item over the budget is trimmed too, a diff is a list of one or two big items
+                if budget - used > MIN_ITEM_BYTES:
+                    item, item_size = _trimmed(item, budget - used)
+                    kept.append(item)
+                    used += item_size
+                break
+            kept.append(item)
+            used += item_size
+        if len(kept) == len(value):
+            return kept, used
+        marker = "[%d items trimmed]" % (len(value) - len(kept))
+        kept.append(marker)
+        return kept, used + len(marker)
+
+    if isinstance(value, str):
+        marker = "[%d bytes trimmed]" % (size - budget)
+        kept = value[: max(budget - len(marker), 0)]
+        return kept + marker, _size(kept) + len(marker)
+
+    marker = "[%d bytes trimmed]" % size
+    return marker, len(marker)
+
+
+class CallbackModule(DefaultCallbackModule):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = "stdout"
+    CALLBACK_NAME = "trim_results"
+
+    def __init__(self):
+        super(CallbackModule, self).__init__()
+        # Bytes of JSON displayed per host
+        self._host_bytes = {}
+        self._spill = None
+        self._spill_failed = False
+
+    def v2_runner_on_ok(self, result):
+        self._trim(result, "ok")
+        super(CallbackModule, self).v2_runner_on_ok(result)
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._trim(result, "failed")
+        super(CallbackModule, self).v2_runner_on_failed(result, ignore_errors)
+
+    def v2_runner_on_skipped(self, result):
+        self._trim(result, "skipped")
+        super(CallbackModule, self).v2_runner_on_skipped(result)
+
+    def v2_runner_on_unreachable(self, result):
+        self._trim(result, "unreachable")
+        super(CallbackModule, self).v2_runner_on_unreachable(result)
+
+    def v2_runner_item_on_ok(self, result):
+        self._trim(result, "item_ok")
+        super(CallbackModule, self).v2_runner_item_on_ok(result)
+
+    def v2_runner_item_on_failed(self, result):
+        self._trim(result, "item_failed")
+        super(CallbackModule, self).v2_runner_item_on_failed(result)
+
+    def v2_runner_item_on_skipped(self, result):
+        self._trim(result, "item_skipped")
+        super(CallbackModule, self).v2_runner_item_on_skipped(result)
+
+    def v2_runner_retry(self, result):
+        self._trim(result, "retry")
+        super(CallbackModule, self).v2_runner_retry(result)
+
+    def v2_runner_on_async_failed(self, result):
+        self._trim(result, "async_failed")
+        super(CallbackModule, self).v2_runner_on_async_failed(result)
+
+    def v2_on_file_diff(self, result):
+        self._trim(result, "diff")
+        super(CallbackModule, self).v2_on_file_diff(result)
+
+    def v2_playbook_on_stats(self, stats):
+        super(CallbackModule, self).v2_playbook_on_stats(stats)
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+            self._display.display("Trimmed results written to %s" % self.get_option("spill_path"))
+
+    def _budget(self, host):
+        budget = self.get_option("max_result_bytes")
+        max_host_bytes = self.get_option("max_host_bytes")
+        if max_host_bytes:
+            left = max(max_host_bytes - self._host_bytes.get(host, 0), MIN_RESULT_BYTES)
+            budget = min(budget, left) if budget else left
+        return budget
+
+    def _trim(self, result, event):
+        """ Cut down the result in place, each callback gets its own copy of it """
+        host = result._host.get_name()
+        data = result._result
+        budget = self._budget(host)
+        if not budget:
+            return
+        trimmed, size = _trimmed(data, budget)
+        if trimmed is not data:
+            self._write_spill(host, result._task.get_name(), event, data)
+            data.clear()
+            data.update(trimmed)
+        before = self._host_bytes.get(host, 0)
+        self._host_bytes[host] = before + size
+        max_host_bytes = self.get_option("max_host_bytes")
+        if max_host_bytes and before < max_host_bytes <= self._host_bytes[host]:
+            self._display.warning(
+                "%s displayed over %d bytes of results, its next results are cut down to %d bytes"
+                % (host, max_host_bytes, MIN_RESULT_BYTES)
+            )
+
+    def _write_spill(self, host, task, event, data):
+        path = self.get_option("spill_path")
+        if not path or self._spill_failed:
+            return
+        try:
+            if self._spill is None:
+                self._spill = open(path, "a")
+            self._spill.write(json.dumps(dict(host=host, task=task, event=event, result=data), default=str))
+            self._spill.write("\n")
+            self._spill.flush()
+        except (IOError, OSError) as e:
+            self._spill_failed = True
+            self._display.warning("Could not write the trimmed results to %s: %s" % (path, e))
@@ -6,6 +6,95 @@ if [ -n "$DEBUG" ]; then
   set -x
 fi
 
+# Not used anymore, ansible-bootstrap compares the versions, but kept for the scripts sourcing this file
+versionIsHigher() {
+  printf '%s\n%s' "$1" "$2" | sort -rC -V
+}
+
+#
+# Bootstrap phases: the independent ones run in the background with phase_start, and phases_wait waits for them.
+# The first phase failing stops the others, and the duration of each phase is printed at the end.
+# The ssh keys are loaded once this file returns, unless the script sourcing it sets PHASES_DEFER_WAIT to start phases
+# of its own, like ansible-runner, and then calls phases_wait before using them
+#
+PHASES_DIR="$(mktemp -d)"
+trap 'rm -rf "$PHASES_DIR"' EXIT
+PHASES_STARTED="$EPOCHREALTIME"
+declare -A PHASE_PIDS
+
+phase_done()
+{
+  local name=$1 started=$2 status=$3
+  echo "$name $started $EPOCHREALTIME $status" >> "$PHASES_DIR/timings"
+}
+
+phase_failed()
+{
+  echo >&2 "######################## Bootstrap phase $1 failed with status $2"
+  phases_table >&2
+  exit $2
+}
+
+# Run a phase in the foreground, for the ones setting the environment
+phase_run()
+{
+  local name=$1 started=$EPOCHREALTIME status=0
+  shift
+  "$@" || status=$?
+  phase_done "$name" "$started" "$status"
+  if [ "$status" -ne 0 ]; then
+    phase_failed "$name" "$status"
+  fi
+}
+
+# Run a phase in the background, its output is printed by phases_wait once it is over
+phase_start()
+{
+  local name=$1
+  shift
+  # In a process group of its own, to be stopped with what it runs
+  set -m
+  (
+    started=$EPOCHREALTIME
+    status=0
+    "$@" > "$PHASES_DIR/$name.log" 2>&1 || status=$?
+    phase_done "$name" "$started" "$status"
+    exit $status
+  ) &
+  PHASE_PIDS[$!]=$name
+  set +m
+}
+
+phases_wait()
+{
+  local pid name status
+  while [ ${#PHASE_PIDS[@]} -gt 0 ]; do
+    status=0
+    wait -n -p pid "${!PHASE_PIDS[@]}" || status=$?
+    name=${PHASE_PIDS[$pid]}
+    unset "PHASE_PIDS[$pid]"
+    echo "######################## Bootstrap phase $name"
+    cat "$PHASES_DIR/$name.log"
+    if [ "$status" -ne 0 ]; then
+      # Stop the other phases, and what they run
+      for pid in "${!PHASE_PIDS[@]}"; do
+        kill -- -$pid 2>/dev/null || true
+      done
+      phase_failed "$name" "$status"
+    fi
+  done
+  phases_table
+}
+
+phases_table()
+{
+  echo "######################## Bootstrap phases"
+  sort -n -k2 "$PHASES_DIR/timings" | awk -v started="$PHASES_STARTED" -v now="$EPOCHREALTIME" '
+    BEGIN { printf "%-12s %8s %9s\n", "phase", "start", "duration" }
+    { printf "%-12s %7.3fs %8.3fs%s\n", $1, $2 - started, $3 - $2, ($4 != 0 ? "  failed with status " $4 : "") }
+    END { printf "%-12s %7.3fs %8.3fs\n", "total", 0, now - started }'
+}
+
 # Keep compatibility with old namings
 export SSH_PRIVATE_KEY="${SSH_PRIVATE_KEY:-$BASTION_PRIVATE_KEY}"
 export EXTRA_ANSIBLE_VARS="${EXTRA_ANSIBLE_VARS:-$EXTRA_VARS}"
@@ -15,7 +104,6 @@ export ANSIBLE_EXTRA_VARS="${ANSIBLE_EXTRA_VARS:-$EXTRA_ANSIBLE_VARS}"
 export AWS_EC2_COMPOSE_ANSIBLE_HOST="${AWS_EC2_COMPOSE_ANSIBLE_HOST:-$EC2_VPC_DESTINATION_VARIABLE}"
 
 export CYCLOID_WORKDIR=$PWD
-export ANSIBLE_VERSION="$(ansible --version | head -n1 | sed -r 's/[^0-9]+([0-9\.]+)[^0-9]+/\1/')"
 export ANSIBLE_REMOTE_USER="${ANSIBLE_REMOTE_USER:-admin}"
 
 # Used to set a default ssh multiplex. You can override it to disable it
@@ -56,131 +144,33 @@ export VMWARE_TEMPLATE_FILE="${VMWARE_TEMPLATE_FILE:-/etc/ansible/hosts-template
 # Construct vars
 #
 
-versionIsHigher() {
-  printf '%s\n%s' "$1" "$2" | sort -rC -V
+# Set ANSIBLE_VERSION, parse the Cycloid credentials, extra vars, tags and ssh keys, and render the inventory
+# templates in a single process. Its output holds the credentials, kept in memory
+bootstrap()
+{
+  BOOTSTRAP="$(ansible-bootstrap)"
 }
-
-# Allow usage of Cycloid creds for cloud provider access
-if [ -n "$CY_AWS_CRED" ]; then
-    export AWS_ACCESS_KEY_ID=$(echo $CY_AWS_CRED | jq -r .access_key)
-    export AWS_SECRET_ACCESS_KEY=$(echo $CY_AWS_CRED | jq -r .secret_key)
-fi
-
-if [ -n "$CY_AZURE_CRED" ]; then
-    export AZURE_SUBSCRIPTION_ID=$(echo $CY_AZURE_CRED | jq -r .subscription_id)
-    export AZURE_TENANT_ID=$(echo $CY_AZURE_CRED | jq -r .tenant_id)
-    export AZURE_CLIENT_ID=$(echo $CY_AZURE_CRED | jq -r .client_id)
-    export AZURE_SECRET=$(echo $CY_AZURE_CRED | jq -r .client_secret)
-fi
-# Depending of Azure tool you use, sometime it request for AZURE_TENANT_ID and sometime for AZURE_TENANT. So providing both
-# Make sure args work for Ansible azure rm and https://raw.githubusercontent.com/ansible/ansible/devel/contrib/inventory/azure_rm.py
-export AZURE_TENANT="${AZURE_TENANT:-$AZURE_TENANT_ID}"
-
-if [ -n "$CY_GCP_CRED" ]; then
-    export GCP_SERVICE_ACCOUNT_CONTENTS=$(echo $CY_GCP_CRED | jq -r .json_key)
-fi
-
-if [ -n "$CY_VMWARE_CRED" ]; then
-    export VMWARE_USERNAME=$(echo $CY_VMWARE_CRED | jq -r .username)
-    export VMWARE_PASSWORD=$(echo $CY_VMWARE_CRED | jq -r .password)
-fi
-
-# actionnable callback is now deprecated: ERROR! [DEPRECATED]: community.general.actionable has been removed. Use the 'default' callback plugin with 'display_skipped_hosts = no' and 'display_ok_hosts = no' options. This feature was removed from community.general in version 2.0.0. Please update your playbooks.
-# In order to keep a backward compatibility using the suggested variables with the default callback
-if [ "$ANSIBLE_STDOUT_CALLBACK" == "actionable" ]; then
-  if versionIsHigher "$ANSIBLE_VERSION" "2.8"; then
-    export ANSIBLE_STDOUT_CALLBACK="default"
-    export ANSIBLE_DISPLAY_OK_HOSTS="no"
-    export ANSIBLE_DISPLAY_SKIPPED_HOSTS="no"
-  fi
-fi
-
-if [ -n "$ANSIBLE_EXTRA_VARS" ]; then
-  # This will read the whole file in a loop, then replaces the newline(s) with a \\n.
-  echo "$ANSIBLE_EXTRA_VARS" | sed ':a;N;$!ba;s/\n/\\n/g' | jq -M . > /tmp/extra_ansible_args.json
-  ANSIBLE_EXTRA_ARGS=" -e @/tmp/extra_ansible_args.json ${ANSIBLE_EXTRA_ARGS}"
-fi
-if [ -n "$TAGS" ]; then
-  ANSIBLE_EXTRA_ARGS=" --tags $(echo $TAGS | jq -r '. | join(",")') ${ANSIBLE_EXTRA_ARGS}"
-fi
-if [ -n "$SKIP_TAGS" ]; then
-  ANSIBLE_EXTRA_ARGS=" --skip-tags $(echo $SKIP_TAGS | jq -r '. | join(",")') ${ANSIBLE_EXTRA_ARGS}"
-fi
-if [ "$AWS_INVENTORY" == "auto" ] && [ -n "$AWS_ACCESS_KEY_ID" ] || [ "${AWS_INVENTORY,,}" == "true" ]; then
-  # Render ec2.ini template from envvars
-  envsubst < $AWS_EC2_TEMPLATE_FILE > /etc/ansible/hosts/aws_ec2.yml
-  ANSIBLE_EXTRA_ARGS=" -i /etc/ansible/hosts/aws_ec2.yml ${ANSIBLE_EXTRA_ARGS}"
-fi
-
-if [ -z "${ANSIBLE_PLUGIN_AZURE_HOST}" ]; then
-  if [ "${AZURE_USE_PRIVATE_IP,,}" == "true" ]; then
-      export ANSIBLE_PLUGIN_AZURE_HOST="${DEFAULT_ANSIBLE_PLUGIN_AZURE_HOST_PRIVATE}"
-  else
-      export ANSIBLE_PLUGIN_AZURE_HOST="${DEFAULT_ANSIBLE_PLUGIN_AZURE_HOST}"
-  fi
-fi
-if [ "$AZURE_INVENTORY" == "auto" ] && [ -n "$AZURE_SUBSCRIPTION_ID" ] || [ "${AZURE_INVENTORY,,}" == "true" ]; then
-  if versionIsHigher "$ANSIBLE_VERSION" "2.8"; then
-    # Render default.azure_rm.yml template from envvars
-    envsubst < $AZURE_TEMPLATE_FILE > /etc/ansible/hosts/azure_rm.yml
-    ANSIBLE_EXTRA_ARGS=" -i /etc/ansible/hosts/azure_rm.yml ${ANSIBLE_EXTRA_ARGS}"
-  else
-    cp /etc/ansible/hosts-template/azure_rm.py /etc/ansible/hosts/
-    ANSIBLE_EXTRA_ARGS=" -i /etc/ansible/hosts/azure_rm.py ${ANSIBLE_EXTRA_ARGS}"
-  fi
-fi
-
-if [ "$GCP_INVENTORY" == "auto" ] && [ -n "$GCP_SERVICE_ACCOUNT_CONTENTS" ] || [ "${GCP_INVENTORY,,}" == "true" ]; then
-  if [ "${GCP_USE_PRIVATE_IP,,}" == "true" ]; then
-      export GCP_NETWORK_INTERFACE_IP="networkInterfaces[0].networkIP"
-  else
-      export GCP_NETWORK_INTERFACE_IP="networkInterfaces[0].accessConfigs[0].natIP"
-  fi
-  export GCP_PROJECT=$(echo $GCP_SERVICE_ACCOUNT_CONTENTS | jq .project_id)
-  export GCP_SERVICE_ACCOUNT_CONTENTS=$(echo $GCP_SERVICE_ACCOUNT_CONTENTS | tr '\n' ' ')
-  # Render default.gcp_compute.yml template from envvars
-  envsubst < $GCP_TEMPLATE_FILE > /etc/ansible/hosts/default.gcp_compute.yml
-  ANSIBLE_EXTRA_ARGS=" -i /etc/ansible/hosts/default.gcp_compute.yml ${ANSIBLE_EXTRA_ARGS}"
-fi
-
-if [ "$VMWARE_VM_INVENTORY" == "auto" ] && [ -n "$VMWARE_SERVER" ] || [ "${VMWARE_VM_INVENTORY,,}" == "true" ]; then
-  # Render default.vmware.yml template from envvars
-  envsubst < $VMWARE_TEMPLATE_FILE > /etc/ansible/hosts/default.vmware.yml
-  ANSIBLE_EXTRA_ARGS=" -i /etc/ansible/hosts/default.vmware.yml ${ANSIBLE_EXTRA_ARGS}"
-fi
+phase_run bootstrap bootstrap
+eval "$BOOTSTRAP"
+unset BOOTSTRAP
 
 # Setup SSH access
-eval $(ssh-agent -s)
-
-# SSH keys
-KEY_ID=1
-if [ -n "$SSH_PRIVATE_KEYS" ]; then
-	IFS=$'\n'
-	for key in $(python -c "import json, os; print('\n'.join([ '%s' % v for v in json.loads(os.environ['SSH_PRIVATE_KEYS'].replace('\\n','\\\\\\\n'))]))"); do
-		# Use the first key as default SSH_PRIVATE_KEY if not defined
-		if [ -z "$SSH_PRIVATE_KEY" ]; then
-			SSH_PRIVATE_KEY=$(echo -e $key)
-			continue
-		fi
-		echo -e "$key" > /root/.ssh/id_rsa${KEY_ID}
-		chmod 600 /root/.ssh/id_rsa${KEY_ID}
-		ssh-add /root/.ssh/id_rsa${KEY_ID}
-		KEY_ID=$((KEY_ID+1))
-	done
-	unset IFS
-fi
-
-if [ -n "$SSH_PRIVATE_KEY" ]; then
-  # Root ssh key
-  echo "${SSH_PRIVATE_KEY}" > /root/.ssh/id_rsa
-  chmod 600  /root/.ssh/id_rsa
-  ssh-add /root/.ssh/id_rsa
-fi
-
-# list ssh keys loaded
-set +e
-ssh-add -l
-set -e
+ssh_agent()
+{
+  eval $(ssh-agent -s)
+}
+phase_run ssh-agent ssh_agent
+
+# SSH keys written by ansible-bootstrap, the ones of SSH_PRIVATE_KEYS then SSH_PRIVATE_KEY, added while the scripts go on
+ssh_keys()
+{
+  for key in $SSH_KEY_FILES; do
+    ssh-add $key || return $?
+  done
+  # list ssh keys loaded
+  ssh-add -l || true
+}
+phase_start ssh-keys ssh_keys
 
 if [ -n "$SSH_JUMP_URL" ]; then
   export ANSIBLE_SSH_ARGS="$ANSIBLE_SSH_ARGS -o 'ProxyJump=$SSH_JUMP_URL' -o 'ForwardAgent=yes'"
@@ -194,3 +184,7 @@ fi
 if [ -n "${ANSIBLE_LIMIT_HOSTS}" ]; then
 	export ANSIBLE_EXTRA_ARGS=" --limit ${ANSIBLE_LIMIT_HOSTS} ${ANSIBLE_EXTRA_ARGS}"
 fi
+
+if [ -z "$PHASES_DEFER_WAIT" ]; then
+  phases_wait
+fi
@@ -1,6 +1,7 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import json
 import os
 import re
 import shutil
@@ -376,6 +377,99 @@ j/McHvs4QerVnwQYfoRaNpFdQwNxL96tYM5M/5jH
         self.assertTrue(self.output_contains(r.output, ".*galaxy.*--force"))
         self.assertEqual(r.exit_code, 0)
 
+    def test_ansible_galaxy_workers(self):
+        environment = {
+            "ANSIBLE_PLAYBOOK_PATH": "galaxy",
+            "ANSIBLE_GALAXY_WORKERS": "4",
+        }
+        r = self.drun(cmd="/usr/bin/ansible-runner", environment=environment)
+        self.assertTrue(self.output_contains(r.output, "^Installing 1 roles and collections with 1 ansible-galaxy, 4 at a time"))
+        self.assertTrue(self.output_contains(r.output, "^######################## ansible-galaxy role install roles/yatesr.timezone"))
+        self.assertEqual(r.exit_code, 0)
+        r = self.drun(cmd="ls -A galaxy")
+        self.assertFalse(self.output_contains(r.output, ".*\\.galaxy-"))
+        r = self.drun(cmd="ls galaxy/roles")
+        self.assertTrue(self.output_contains(r.output, "^yatesr.timezone"))
+
+        # Forced, a linked role is replaced without emptying what it links to
+        self.drun(cmd="bash -c 'rm -rf galaxy/roles/yatesr.timezone && mkdir -p /tmp/linked && touch /tmp/linked/kept && ln -s /tmp/linked galaxy/roles/yatesr.timezone'")
+        environment["ANSIBLE_FORCE_GALAXY"] = "true"
+        r = self.drun(cmd="/usr/bin/ansible-runner", environment=environment)
+        self.assertEqual(r.exit_code, 0)
+        r = self.drun(cmd="test ! -L galaxy/roles/yatesr.timezone -a -f /tmp/linked/kept")
+        self.assertEqual(r.exit_code, 0)
+
+        # Empty is the default, in a row
+        environment["ANSIBLE_GALAXY_WORKERS"] = ""
+        r = self.drun(cmd="/usr/bin/ansible-runner", environment=environment)
+        self.assertFalse(self.output_contains(r.output, "^Installing 1 roles and collections"))
+        self.assertEqual(r.exit_code, 0)
+
+        environment["ANSIBLE_GALAXY_WORKERS"] = "four"
+        r = self.drun(cmd="/usr/bin/ansible-runner", environment=environment)
+        self.assertTrue(self.output_contains(r.output, "^ANSIBLE_GALAXY_WORKERS must be a number, got 'four'"))
+        self.assertNotEqual(r.exit_code, 0)
+
+    def test_bootstrap_phases(self):
+        environment = {
+            "ANSIBLE_PLAYBOOK_PATH": "galaxy",
+        }
+        r = self.drun(cmd="/usr/bin/ansible-runner", environment=environment)
+        self.assertTrue(self.output_contains(r.output, "^######################## Bootstrap phase galaxy$"))
+        self.assertTrue(self.output_contains(r.output, "^######################## Bootstrap phases"))
+        self.assertTrue(self.output_contains(r.output, "^galaxy +[0-9.]+s +[0-9.]+s$"))
+        self.assertEqual(r.exit_code, 0)
+
+        # The first phase failing stops the run with its status
+        environment["TAGS"] = "[invalid"
+        r = self.drun(cmd="/usr/bin/ansible-runner", environment=environment)
+        self.assertTrue(self.output_contains(r.output, "^######################## Bootstrap phase bootstrap failed with status 2"))
+        self.assertFalse(self.output_contains(r.output, "^######## Running ansible playbook"))
+        self.assertEqual(r.exit_code, 2)
+
+    def test_bootstrap_sourced(self):
+        # Without PHASES_DEFER_WAIT, the ssh keys are loaded once ansible-common.sh returns
+        cmd = "bash -c 'source /usr/bin/ansible-common.sh > /dev/null; ssh-add -l; echo PHASES_DIR=$PHASES_DIR'"
+        r = self.drun(cmd=cmd)
+        self.assertEqual(r.exit_code, 0)
+        self.assertTrue(self.output_contains(r.output, "^1024 SHA256:.*\\(RSA\\)$"))
+        # Removed on exit, the bootstrap output with the credentials is never written there
+        phases_dir = re.search("PHASES_DIR=(\\S+)", r.output.decode("utf-8")).group(1)
+        r = self.drun(cmd="test -e %s" % phases_dir)
+        self.assertNotEqual(r.exit_code, 0)
+
+    def test_ansible_galaxy_cache(self):
+        environment = {
+            "ANSIBLE_PLAYBOOK_PATH": "galaxy",
+            "ANSIBLE_GALAXY_CACHE_DIR": "/tmp/galaxy-cache",
+        }
+        r = self.drun(cmd="/usr/bin/ansible-runner", environment=environment)
+        self.assertTrue(self.output_contains(r.output, "^Installing requirements.yml into the galaxy cache"))
+        self.assertEqual(r.exit_code, 0)
+
+        # Linked from the cache, without ansible-galaxy
+        self.drun(cmd="rm -rf galaxy/roles")
+        r = self.drun(cmd="/usr/bin/ansible-runner", environment=environment)
+        self.assertTrue(self.output_contains(r.output, "^Restoring requirements.yml from the galaxy cache"))
+        self.assertFalse(self.output_contains(r.output, ".*yatesr.timezone.*was installed successfully"))
+        self.assertEqual(r.exit_code, 0)
+        r = self.drun(cmd="ls galaxy/roles")
+        self.assertTrue(self.output_contains(r.output, "^yatesr.timezone"))
+
+        # A forced restore replaces a linked role without emptying what it links to
+        self.drun(cmd="bash -c 'rm -rf galaxy/roles/yatesr.timezone && mkdir -p /tmp/linked && touch /tmp/linked/kept && ln -s /tmp/linked galaxy/roles/yatesr.timezone'")
+        environment["ANSIBLE_FORCE_GALAXY"] = "true"
+        environment["ANSIBLE_GALAXY_CACHE_MAX_SIZE"] = ""
+        r = self.drun(cmd="/usr/bin/ansible-runner", environment=environment)
+        self.assertEqual(r.exit_code, 0)
+        r = self.drun(cmd="test ! -L galaxy/roles/yatesr.timezone -a -f /tmp/linked/kept")
+        self.assertEqual(r.exit_code, 0)
+
+        environment["ANSIBLE_GALAXY_CACHE_MAX_SIZE"] = "1G"
+        r = self.drun(cmd="/usr/bin/ansible-runner", environment=environment)
+        self.assertTrue(self.output_contains(r.output, "^ANSIBLE_GALAXY_CACHE_MAX_SIZE must be a number, got '1G'"))
+        self.assertNotEqual(r.exit_code, 0)
+
     def test_basic(self):
         environment = {
             "EXTRA_ANSIBLE_VARS": "",
@@ -411,6 +505,29 @@ j/McHvs4QerVnwQYfoRaNpFdQwNxL96tYM5M/5jH
         r = self.drun(cmd="cat playbook/.vault-password")
         self.assertTrue(self.output_contains(r.output, ".*password"))
 
+    def test_manifest(self):
+        # Written when the image is built, for ansible-bootstrap to get ANSIBLE_VERSION from
+        r = self.drun(cmd="cat /etc/ansible/manifest.json")
+        self.assertEqual(r.exit_code, 0)
+        manifest = json.loads(r.output.decode("utf-8"))
+        self.assertTrue(manifest["ansible_core"].startswith(self.ansible_version))
+        self.assertIn("amazon.aws", manifest["collections"])
+
+        cmd = "bash -c 'source /usr/bin/ansible-common.sh > /dev/null; echo ANSIBLE_VERSION=$ANSIBLE_VERSION'"
+        r = self.drun(cmd=cmd)
+        self.assertTrue(self.output_contains(r.output, "^ANSIBLE_VERSION=%s$" % re.escape(manifest["ansible_core"])))
+
+        # Probed without the manifest
+        self.drun(cmd="rm /etc/ansible/manifest.json")
+        r = self.drun(cmd=cmd)
+        self.assertTrue(self.output_contains(r.output, "^ANSIBLE_VERSION=%s$" % re.escape(manifest["ansible_core"])))
+
+    def test_version_is_higher(self):
+        # Still defined for the scripts sourcing ansible-common.sh
+        cmd = "bash -c 'source /usr/bin/ansible-common.sh > /dev/null; versionIsHigher 2.10 2.9 && ! versionIsHigher 2.8 2.9'"
+        r = self.drun(cmd=cmd)
+        self.assertEqual(r.exit_code, 0, r.output)
+
     def test_extra_args(self):
         environment = {
             "ANSIBLE_FAIL_WHEN_NO_HOST": "false",
@@ -455,6 +572,35 @@ j/McHvs4QerVnwQYfoRaNpFdQwNxL96tYM5M/5jH
         r = self.drun(cmd="cat /tmp/extra_ansible_args.json")
         self.assertTrue(self.output_contains(r.output, ".*bar.+42"))
 
+    def test_retry_failed(self):
+        # The playbook fails on its first run only
+        environment = {
+            "ANSIBLE_PLAYBOOK_NAME": "flaky.yml",
+        }
+        self.drun(cmd="rm -f /tmp/flaky")
+        # Retry files of the user are left alone without retries
+        self.drun(cmd="sh -c 'mkdir -p /tmp/retries && echo localhost > /tmp/retries/flaky.retry'")
+        r = self.drun(
+            cmd="/usr/bin/ansible-runner",
+            environment=dict(environment, ANSIBLE_RETRY_FILES_SAVE_PATH="/tmp/retries"),
+        )
+        self.assertNotEqual(r.exit_code, 0)
+        self.assertFalse(self.output_contains(r.output, ".*rm -f .*flaky.retry"))
+        r = self.drun(cmd="cat /tmp/retries/flaky.retry")
+        self.assertEqual(r.exit_code, 0)
+
+        environment["ANSIBLE_RETRY_FAILED"] = "2"
+        self.drun(cmd="rm -f /tmp/flaky")
+        r = self.drun(cmd="/usr/bin/ansible-runner", environment=environment)
+        self.assertTrue(self.output_contains(r.output, ".*Retrying ansible playbook flaky.yml \\(1/2\\) on localhost"))
+        self.assertTrue(self.output_contains(r.output, ".*ansible-playbook.*--limit @.*flaky.retry.1"))
+        self.assertTrue(self.output_contains(r.output, ".*succeeded after 1 retries"))
+        self.assertEqual(r.exit_code, 0)
+        # The retry files are removed with their directory once over
+        retry_path = re.search(r"--limit @(\S+)/flaky.retry.1", r.output.decode("utf-8")).group(1)
+        r = self.drun(cmd="test -e %s" % retry_path)
+        self.assertNotEqual(r.exit_code, 0)
+
     def test_ssh_jumps_args(self):
         environment = {
             "BASTION_URL": "root@localhost",
@@ -1030,6 +1176,101 @@ class CallbackPluginsTestCase(TestCase):
             f"\nTrace:\n{r.output.decode('utf-8')}",
         )
 
+    def test_unreachable_tolerated(self):
+        environment = {
+            "ANSIBLE_PLAYBOOK_NAME": "unreachable.yml",
+            "ANSIBLE_PLAYBOOK_PATH": "/opt",
+            "ANSIBLE_FAILER_MAX_UNREACHABLE": "1",
+            "ANSIBLE_FAILER_UNREACHABLE_FILE": "/tmp/unreachable",
+        }
+        r = self.drun(
+            cmd="ansible-runner",
+            environment=environment,
+        )
+        # The playbook goes on with the reachable hosts, and fails once it is over
+        self.assertEqual(r.exit_code, 1, r.output.decode("utf-8"))
+        self.assertTrue(self.output_contains(r.output, ".*still running.*"), r.output)
+        self.assertTrue(self.output_contains(r.output, ".*Unreachable hosts: unreachable.*"), r.output)
+
+        r = self.drun(cmd="cat /tmp/unreachable")
+        self.assertEqual(r.output.decode("utf-8"), "unreachable\n")
+
+    def test_unreachable_default(self):
+        environment = {
+            "ANSIBLE_PLAYBOOK_NAME": "unreachable.yml",
+            "ANSIBLE_PLAYBOOK_PATH": "/opt",
+        }
+        r = self.drun(
+            cmd="ansible-runner",
+            environment=environment,
+        )
+        # Unreachable hosts do not stop the playbook, which exits with the status of ansible-playbook
+        self.assertEqual(r.exit_code, 4, r.output.decode("utf-8"))
+        self.assertTrue(self.output_contains(r.output, ".*still running.*"), r.output)
+        self.assertTrue(self.output_contains(r.output, ".*Unreachable hosts: unreachable.*"), r.output)
+
+    def test_unreachable_not_tolerated(self):
+        environment = {
+            "ANSIBLE_PLAYBOOK_NAME": "unreachable.yml",
+            "ANSIBLE_PLAYBOOK_PATH": "/opt",
+            "ANSIBLE_FAILER_MAX_UNREACHABLE": "0",
+        }
+        r = self.drun(
+            cmd="ansible-runner",
+            environment=environment,
+        )
+        self.assertEqual(r.exit_code, 1, r.output.decode("utf-8"))
+        self.assertFalse(self.output_contains(r.output, ".*still running.*"), r.output)
+
+    def test_pipeline_profile(self):
+        environment = {
+            "ANSIBLE_PLAYBOOK_NAME": "profile.yml",
+            "ANSIBLE_PLAYBOOK_PATH": "/opt",
+            "ANSIBLE_PIPELINE_PROFILE": "/tmp/profile.json",
+        }
+        r = self.drun(
+            cmd="ansible-runner",
+            environment=environment,
+        )
+        self.assertEqual(r.exit_code, 0, r.output.decode("utf-8"))
+
+        r = self.drun(cmd="cat /tmp/profile.json")
+        self.assertEqual(r.exit_code, 0, r.output.decode("utf-8"))
+        profile = json.loads(r.output)
+        self.assertEqual(profile["playbook"], "profile.yml")
+        self.assertEqual([task["name"] for task in profile["tasks"]], ["wait", "test"])
+        wait = profile["tasks"][0]
+        self.assertGreaterEqual(wait["duration"], 1)
+        self.assertGreaterEqual(wait["first_result"], 1)
+        self.assertEqual(wait["hosts"]["localhost"]["status"], "ok")
+        self.assertEqual(wait["slowest_hosts"][0]["host"], "localhost")
+        self.assertEqual(profile["hosts"]["localhost"]["tasks"], 2)
+        self.assertEqual(profile["stats"]["localhost"]["ok"], 2)
+
+    def test_trim_results(self):
+        environment = {
+            "ANSIBLE_PLAYBOOK_NAME": "trim.yml",
+            "ANSIBLE_PLAYBOOK_PATH": "/opt",
+            "ANSIBLE_STDOUT_CALLBACK": "trim_results",
+            "ANSIBLE_TRIM_RESULT_BYTES": "4096",
+            "ANSIBLE_TRIM_SPILL_PATH": "/tmp/trimmed.ndjson",
+            "EXTRA_ANSIBLE_ARGS": "-v",
+        }
+        r = self.drun(
+            cmd="ansible-runner",
+            environment=environment,
+        )
+        self.assertEqual(r.exit_code, 0, r.output.decode("utf-8"))
+        self.assertTrue(self.output_contains(r.output, ".*items trimmed"))
+        self.assertTrue(self.output_contains(r.output, ".*not trimmed"))
+        self.assertLess(len(r.output), 100000)
+
+        r = self.drun(cmd="cat /tmp/trimmed.ndjson")
+        self.assertEqual(r.exit_code, 0, r.output.decode("utf-8"))
+        spilled = [json.loads(line) for line in r.output.decode("utf-8").splitlines()]
+        self.assertEqual([(result["host"], result["task"]) for result in spilled], [("localhost", "big")])
+        self.assertEqual(len(spilled[0]["result"]["stdout_lines"]), 100000)
+
     def test_ansible_runner_plugin_disabled(self):
         environment = {
             "ANSIBLE_FAIL_WHEN_NO_HOST": "false",
@@ -1050,6 +1291,385 @@ class CallbackPluginsTestCase(TestCase):
         )
 
 
+class AzureRmInventoryTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.container = self.docker.containers.run(
+            image=self.docker_image,
+            command="sleep 3600",
+            name=self.__class__.__name__,
+            auto_remove=True,
+            remove=True,
+            detach=True,
+            working_dir="/opt",
+            volumes={
+                osjoin(os.getcwd(), "%s/azure-rm" % self.testsdir): {
+                    "bind": "/opt",
+                    "mode": "rw",
+                }
+            },
+        )
+        # Stand-in for the cloud metadata, ADFS token and Resource Graph endpoints, over TLS as the SDK requires
+        r = self.drun(
+            cmd=[
+                "sh",
+                "-c",
+                "openssl req -x509 -newkey rsa:2048 -nodes -days 1 -subj /CN=localhost "
+                "-addext subjectAltName=DNS:localhost -keyout /tmp/key.pem -out /tmp/cert.pem "
+                "&& cat /tmp/key.pem /tmp/cert.pem > /tmp/server.pem",
+            ]
+        )
+        self.assertEqual(r.exit_code, 0, r.output)
+        r = self.drun(
+            cmd="python /opt/resource_graph_server.py --port 8443 --cert /tmp/server.pem --log /tmp/queries.log"
+        )
+        self.assertEqual(r.exit_code, 0, r.output)
+        self.environment = {
+            "AZURE_CLOUD_ENVIRONMENT": "https://localhost:8443/",
+            "AZURE_CLIENT_ID": "client",
+            "AZURE_SECRET": "secret",
+            "AZURE_TENANT": "adfs",
+            "AZURE_SUBSCRIPTION_ID": "00000000-0000-0000-0000-000000000000",
+            "REQUESTS_CA_BUNDLE": "/tmp/cert.pem",
+        }
+
+    def inventory(self, environment):
+        r = self.drun(
+            cmd=["sh", "-c", "python /etc/ansible/hosts-template/azure_rm.py --list 2>/dev/null"],
+            environment=dict(self.environment, **environment),
+        )
+        self.assertEqual(r.exit_code, 0, r.output)
+        return json.loads(r.output.decode("utf-8"))
+
+    def test_resource_graph_backend(self):
+        inventory = self.inventory({"AZURE_INVENTORY_BACKEND": "resource_graph"})
+
+        self.assertEqual(inventory["azure"], ["web-1", "win-1"])
+        self.assertEqual(inventory["web-nsg"], ["web-1"])
+        self.assertEqual(inventory["env_prod"], ["web-1"])
+        self.assertEqual(inventory["windows"], ["win-1"])
+
+        web = inventory["_meta"]["hostvars"]["web-1"]
+        self.assertEqual(web["ansible_host"], "20.0.0.1")
+        self.assertEqual(web["private_ip"], "10.0.0.4")
+        self.assertEqual(web["fqdn"], "web-1.westeurope.cloudapp.azure.com")
+        self.assertEqual(web["network_interface"], "web-1-nic")
+        self.assertEqual(web["security_group"], "web-nsg")
+        self.assertEqual(web["resource_group"], "galaxy-production")
+        self.assertEqual(web["type"], "Microsoft.Compute/virtualMachines")
+        self.assertEqual(web["os_disk"], {"name": "web-1-disk", "operating_system_type": "linux"})
+        self.assertEqual(web["powerstate"], "running")
+
+        win = inventory["_meta"]["hostvars"]["win-1"]
+        self.assertEqual(win["ansible_connection"], "winrm")
+        self.assertIsNone(win["ansible_host"])
+        self.assertEqual(win["plan"], "windows-plan")
+        self.assertEqual(win["powerstate"], "deallocated")
+        self.assertEqual(
+            win["windows_rm"],
+            {"listeners": [{"protocol": "https", "certificate_url": "https://vault.example/secrets/winrm"}]},
+        )
+
+    def test_minimal(self):
+        inventory = self.inventory(
+            {
+                "AZURE_INVENTORY_BACKEND": "resource_graph",
+                "AZURE_MINIMAL": "yes",
+                "AZURE_USE_PRIVATE_IP": "yes",
+            }
+        )
+
+        self.assertNotIn("web-nsg", inventory)
+        web = inventory["_meta"]["hostvars"]["web-1"]
+        self.assertEqual(web["ansible_host"], "10.0.0.4")
+        self.assertIsNone(web["public_ip"])
+        for key in ("image", "powerstate", "security_group"):
+            self.assertNotIn(key, web)
+        win = inventory["_meta"]["hostvars"]["win-1"]
+        self.assertEqual(win["ansible_connection"], "winrm")
+        self.assertNotIn("windows_rm", win)
+
+        r = self.drun(cmd="cat /tmp/queries.log")
+        self.assertNotIn(b"publicipaddresses", r.output)
+
+    def test_resource_graph_filters(self):
+        self.inventory(
+            {
+                "AZURE_INVENTORY_BACKEND": "resource_graph",
+                "AZURE_RESOURCE_GROUPS": "galaxy-production",
+                "AZURE_TAGS": "env:prod,role",
+            }
+        )
+
+        r = self.drun(cmd="cat /tmp/queries.log")
+        queries = [json.loads(line) for line in r.output.decode("utf-8").split("\r\n") if line != ""]
+        # Three pages of two resources
+        self.assertEqual(len(queries), 3)
+        self.assertEqual(queries[0]["subscriptions"], ["00000000-0000-0000-0000-000000000000"])
+        self.assertEqual(queries[2]["options"]["$skipToken"], "4")
+        self.assertIn("resourceGroup in~ ('galaxy-production')", queries[0]["query"])
+        self.assertIn("tostring(tags['env']) == 'prod' and isnotnull(tags['role'])", queries[0]["query"])
+
+
+class AzureRmSdkBackendTestCase(TestCase):
+    """ azure_rm.py with the sdk backend, its Azure clients replaced by the fakes of fake_arm.py """
+
+    def setUp(self):
+        super().setUp()
+        self.container = self.docker.containers.run(
+            image=self.docker_image,
+            command="sleep 3600",
+            name=self.__class__.__name__,
+            auto_remove=True,
+            remove=True,
+            detach=True,
+            working_dir="/opt",
+            volumes={
+                osjoin(os.getcwd(), "%s/azure-rm" % self.testsdir): {
+                    "bind": "/opt",
+                    "mode": "rw",
+                }
+            },
+        )
+        self.environment = {
+            "AZURE_SUBSCRIPTION_ID": "00000000-0000-0000-0000-000000000000,11111111-1111-1111-1111-111111111111",
+        }
+
+    def inventory(self, args="", fake_args="", environment=None):
+        """ The inventory azure_rm.py --list writes with args, the API calls it made are left in /tmp/calls.json """
+        r = self.drun(
+            cmd=[
+                "sh",
+                "-c",
+                "python /opt/fake_arm.py --calls /tmp/calls.json %s -- --list %s 2>/dev/null" % (fake_args, args),
+            ],
+            environment=dict(self.environment, **(environment or {})),
+        )
+        self.assertEqual(r.exit_code, 0, r.output)
+        return json.loads(r.output.decode("utf-8"))
+
+    def calls(self):
+        r = self.drun(cmd="cat /tmp/calls.json")
+        return json.loads(r.output.decode("utf-8"))
+
+    def test_workers(self):
+        baseline = self.inventory()
+        self.assertEqual(len(baseline["azure"]), 12)
+        calls = self.calls()
+
+        # Same hosts and groups, in the same order, with the same calls made
+        inventory = self.inventory("--workers 8")
+        self.assertEqual(inventory, baseline)
+        self.assertEqual(list(inventory["_meta"]["hostvars"]), list(baseline["_meta"]["hostvars"]))
+        self.assertEqual(self.calls(), calls)
+
+    def test_prefetch_network(self):
+        baseline = self.inventory()
+
+        inventory = self.inventory("--prefetch-network --workers 4")
+        self.assertEqual(inventory, baseline)
+        calls = self.calls()
+        self.assertNotIn("network_interfaces.get", calls)
+        self.assertNotIn("public_ip_addresses.get", calls)
+        # One listing per subscription, of two items per page
+        self.assertEqual(calls["network_interfaces.list_all"], 5 * 2)
+        self.assertEqual(calls["public_ip_addresses.list_all"], 2 * 2)
+
+        # Or per selected resource group
+        baseline = self.inventory("--resource-groups galaxy-staging")
+        inventory = self.inventory("--prefetch-network --resource-groups galaxy-staging")
+        self.assertEqual(inventory, baseline)
+        calls = self.calls()
+        self.assertNotIn("network_interfaces.get", calls)
+        self.assertEqual(calls["network_interfaces.list"], 2 * 2)
+
+    def test_bulk_powerstate(self):
+        baseline = self.inventory()
+        self.assertEqual(baseline["_meta"]["hostvars"]["win-11"]["powerstate"], "deallocated")
+
+        inventory = self.inventory("--bulk-powerstate --workers 4")
+        self.assertEqual(inventory, baseline)
+        calls = self.calls()
+        self.assertNotIn("virtual_machines.instance_view", calls)
+        self.assertEqual(calls["virtual_machines.list_all(status_only)"], 3 * 2)
+
+        # 12 instance views avoided, less the 6 pages of the status listings
+        r = self.drun(
+            cmd=["sh", "-c", "python /opt/fake_arm.py -- --list --bulk-powerstate 2>&1 >/dev/null"],
+            environment=self.environment,
+        )
+        self.assertTrue(self.output_contains(r.output, "^azure_rm: bulk powerstate listing saved 6 compute API calls$"))
+
+    def test_cache(self):
+        environment = {"AZURE_CACHE_MAX_AGE": "300", "AZURE_CACHE_PATH": "/tmp/cache"}
+        baseline = self.inventory()
+
+        inventory = self.inventory(environment=environment)
+        self.assertEqual(inventory, baseline)
+        r = self.drun(cmd="sh -c 'ls /tmp/cache | wc -l'")
+        self.assertTrue(self.output_contains(r.output, "^1$"))
+
+        # Answered from the cache while fresh, without any API call
+        inventory = self.inventory(fake_args="--remove web-0", environment=environment)
+        self.assertEqual(inventory, baseline)
+        self.assertEqual(self.calls(), {})
+
+        # Rebuilt with --refresh-cache
+        inventory = self.inventory("--refresh-cache", "--remove web-0", environment=environment)
+        self.assertNotIn("web-0", inventory["azure"])
+        self.assertIn("virtual_machines.list_all", self.calls())
+
+        # No cache without a subscription known before authenticating, no run could look it up
+        self.drun(cmd="rm -rf /tmp/cache")
+        inventory = self.inventory(environment=dict(environment, AZURE_SUBSCRIPTION_ID=""))
+        self.assertEqual(inventory, baseline)
+        r = self.drun(cmd="ls /tmp/cache")
+        self.assertNotEqual(r.exit_code, 0)
+
+    def test_incremental_refresh(self):
+        environment = {"AZURE_CACHE_MAX_AGE": "300", "AZURE_CACHE_PATH": "/tmp/cache", "AZURE_CACHE_INCREMENTAL": "yes"}
+        self.inventory(environment=environment)
+        self.drun(cmd="sh -c 'touch -d \"1 hour ago\" /tmp/cache/ansible-azure_rm-*'")
+
+        # web-0 changed, db.4 was deleted and web-6 was stopped since the cache expired
+        fake_args = "--change web-0 --remove db.4 --stop web-6"
+        inventory = self.inventory(fake_args=fake_args, environment=environment)
+        calls = self.calls()
+        baseline = self.inventory(fake_args=fake_args)
+        self.assertEqual(inventory, baseline)
+        self.assertEqual(inventory["_meta"]["hostvars"]["web-0"]["public_ip"], "20.1.0.1")
+        self.assertEqual(inventory["_meta"]["hostvars"]["web-6"]["powerstate"], "deallocated")
+        self.assertNotIn("db_4", inventory["_meta"]["hostvars"])
+
+        # Only web-0, and its two network interfaces, are resolved again, power states come from one listing
+        self.assertEqual(calls["network_interfaces.get"], 2)
+        self.assertEqual(calls["public_ip_addresses.get"], 1)
+        self.assertEqual(calls["network_security_groups.list"], 1)
+        self.assertNotIn("virtual_machines.instance_view", calls)
+        self.assertEqual(calls["virtual_machines.list_all(status_only)"], 3 * 2)
+
+    def test_host(self):
+        baseline = self.inventory()
+
+        inventory = self.inventory("--host db.7")
+        self.assertEqual(inventory["_meta"]["hostvars"], {"db_7": baseline["_meta"]["hostvars"]["db_7"]})
+        for group, hosts in baseline.items():
+            if group != "_meta" and "db_7" in hosts:
+                self.assertEqual(inventory[group], ["db_7"])
+        # Looked up by name in each subscription, without listing the machines
+        calls = self.calls()
+        self.assertEqual(calls["resources.list"], 2)
+        self.assertEqual(calls["virtual_machines.get"], 1)
+        self.assertNotIn("virtual_machines.list_all", calls)
+
+        # Fetched from the selected resource groups, a 404 in the others
+        inventory = self.inventory("--host db.7 --resource-groups galaxy-staging,galaxy-production")
+        self.assertEqual(inventory["_meta"]["hostvars"], {"db_7": baseline["_meta"]["hostvars"]["db_7"]})
+        self.assertNotIn("resources.list", self.calls())
+
+        inventory = self.inventory("--host missing")
+        self.assertEqual(inventory["azure"], [])
+
+    def test_subscriptions(self):
+        baseline = self.inventory()
+        first = self.inventory("--subscription_id 00000000-0000-0000-0000-000000000000")
+        second = self.inventory(environment={"AZURE_SUBSCRIPTION_ID": "11111111-1111-1111-1111-111111111111"})
+        # The hosts of each subscription, in the order they are given
+        self.assertEqual(baseline["azure"], first["azure"] + second["azure"])
+        self.assertEqual(len(first["azure"]), 6)
+
+        # Subscriptions and resource groups are enumerated concurrently, the output keeps their order
+        self.assertEqual(self.inventory("--workers 4"), baseline)
+        args = "--resource-groups galaxy-staging,galaxy-production"
+        baseline = self.inventory(args)
+        self.assertEqual(baseline["azure"][:3], ["web-3", "db_4", "win-5"])
+        self.assertEqual(self.inventory(args + " --workers 4"), baseline)
+
+    def test_prefetch_security_groups(self):
+        baseline = self.inventory()
+        self.assertEqual(baseline["galaxy-staging-nsg"], ["web-3", "win-5", "web-9", "win-11"])
+
+        inventory = self.inventory("--prefetch-security-groups --workers 4")
+        self.assertEqual(inventory, baseline)
+        calls = self.calls()
+        self.assertNotIn("network_security_groups.list", calls)
+        # One listing per subscription, of two security groups
+        self.assertEqual(calls["network_security_groups.list_all"], 2)
+
+    def test_streaming(self):
+        baseline = self.inventory()
+
+        # Listings read one machine ahead, while up to 4 workers resolve hosts
+        inventory = self.inventory("--workers 4", environment={"AZURE_READ_AHEAD": "1"})
+        self.assertEqual(inventory, baseline)
+
+        # Written one host at a time, as json.dumps would
+        r = self.drun(
+            cmd=["sh", "-c", "python /opt/fake_arm.py -- --list 2>/dev/null"],
+            environment=self.environment,
+        )
+        output = r.output.decode("utf-8").rstrip("\r\n")
+        self.assertEqual(output, json.dumps(json.loads(output)))
+
+    def test_groups(self):
+        inventory = self.inventory("--workers 4")
+
+        # The groups of each host, from its host vars
+        expected = dict(azure=[])
+        for name, host_vars in inventory["_meta"]["hostvars"].items():
+            groups = [host_vars["os_disk"]["operating_system_type"], host_vars["resource_group"], host_vars["location"]]
+            if host_vars.get("security_group"):
+                groups.append(host_vars["security_group"])
+            groups.append("azure")
+            for key, value in (host_vars["tags"] or {}).items():
+                groups.extend([key, "%s_%s" % (key, value)])
+            for group in groups:
+                expected.setdefault(re.sub(r"[^A-Za-z0-9\_\-]", "_", group), []).append(name)
+        self.assertEqual(inventory, dict(expected, _meta=inventory["_meta"]))
+        self.assertEqual(inventory["cost_center_R_D_1"], ["web-6", "db_7", "win-8", "web-9", "db_10", "win-11"])
+        self.assertNotIn("win-5", inventory["env"])
+
+    def test_profile(self):
+        baseline = self.inventory()
+        calls = self.calls()
+
+        # The inventory is unchanged, and every call is counted by operation
+        inventory = self.inventory("--inventory-profile /tmp/profile.json")
+        self.assertEqual(inventory, baseline)
+        r = self.drun(cmd="cat /tmp/profile.json")
+        profile = json.loads(r.output.decode("utf-8"))
+        self.assertEqual(set(profile["operations"]), set(calls))
+        for name in ("network_interfaces.get", "public_ip_addresses.get", "virtual_machines.instance_view"):
+            self.assertEqual(profile["operations"][name]["calls"], calls[name])
+        # A listing is one call whatever its number of pages, each page is one response
+        self.assertEqual(profile["operations"]["virtual_machines.list_all"]["calls"], 2)
+        self.assertEqual(profile["operations"]["virtual_machines.list_all"]["items"], 12)
+        self.assertEqual(profile["responses"]["count"], sum(calls.values()))
+        self.assertEqual(profile["remaining_subscription_reads"], 11999)
+
+    def test_throttle_recovery(self):
+        baseline = self.inventory()
+
+        # The first call is throttled, its page is fetched again and the concurrency grows back to 8
+        inventory = self.inventory("--workers 4 --inventory-profile /tmp/profile.json", "--throttle 1")
+        self.assertEqual(inventory, baseline)
+        r = self.drun(cmd="cat /tmp/profile.json")
+        throttle = json.loads(r.output.decode("utf-8"))["throttle"]
+        self.assertEqual(throttle["throttled"], 1)
+        self.assertEqual(throttle["retries"], 1)
+        self.assertEqual(throttle["lowest_concurrency"], 4)
+        self.assertEqual(throttle["concurrency"], 8)
+        self.assertEqual(throttle["max_concurrency"], 8)
+
+        # Not retried past --max-retries
+        r = self.drun(
+            cmd="python /opt/fake_arm.py --throttle 2 -- --list --max-retries 1",
+            environment=self.environment,
+        )
+        self.assertEqual(r.exit_code, 1)
+        self.assertTrue(self.output_contains(r.output, "^Error: fetching virtual machines - Too many requests"))
+
+
 if __name__ == "__main__":
     with tempfile.TemporaryDirectory() as tmpdir:
         unittest.main()
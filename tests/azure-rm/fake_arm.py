@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Runs azure_rm.py with the default sdk backend against in-process fakes of the compute, network and resource
+# clients, answering for a small fleet of two subscriptions: machines in several resource groups, with network
+# interfaces, public IPs, security groups, tags, a Windows host and a deallocated one. Listings return pages of
+# two items, to exercise the paging and the read ahead.
+#
+# The inventory is written to stdout by azure_rm.py, and the API calls made by operation to the calls file:
+#   fake_arm.py --calls calls.json -- --list --workers 4
+# --change and --remove alter the fleet, like changes made in Azure between two runs. --throttle answers the
+# first calls with HTTP 429, and every response carries the x-ms-ratelimit-remaining-subscription-reads header.
+#
+# benchmarks/azure_rm_fleet.py imports this module, to run azure_rm.py against larger fleets of its own: a Fleet
+# is filled with any number of machines, and sets the page size of the listings and the latency of every call.
+
+import argparse
+import collections
+import importlib.util
+import json
+import os
+import re
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+PAGE_SIZE = 2
+SUBSCRIPTION_IDS = ("00000000-0000-0000-0000-000000000000", "11111111-1111-1111-1111-111111111111")
+RESOURCE_GROUPS = ("galaxy-production", "galaxy-staging")
+REMAINING_READS = "11999"
+
+
+class Throttled(Exception):
+    """ An HTTP 429 answer, as raised by the SDK """
+
+    status_code = 429
+
+    def __init__(self):
+        super(Throttled, self).__init__("Too many requests")
+        self.response = SimpleNamespace(status_code=429, headers={"Retry-After": "0"})
+
+
+class NotFound(Exception):
+    status_code = 404
+
+
+class Fleet(object):
+    """ The machines of each subscription and the network resources they use, as the SDK models azure_rm.py reads.
+        Resources are indexed by their lower case id, so that gets stay cheap on fleets of thousands of machines. """
+
+    def __init__(self, subscription_ids=SUBSCRIPTION_IDS, throttle=0, latency=0.0, page_size=PAGE_SIZE):
+        self.subscription_ids = subscription_ids
+        self.page_size = page_size
+        self.calls = collections.Counter()
+        self._throttle = throttle
+        self._latency = latency
+        self._lock = threading.Lock()
+        self.machines = dict()
+        self.interfaces = dict()
+        self.addresses = dict()
+        self.security_groups = dict()
+
+    def machine(self, name):
+        return next(machine for machine in self.machines.values() if machine.name == name)
+
+    def change(self, name):
+        """ A machine whose provisioning state and public IP changed """
+        machine = self.machine(name)
+        machine.provisioning_state = "Updating"
+        for address in self.addresses.values():
+            if address.name == "%s-ip" % name:
+                address.ip_address = "20.1.0.1"
+
+    def stop(self, name):
+        """ A machine which was deallocated """
+        self.machine(name).instance_view.statuses[-1].code = "PowerState/deallocated"
+
+    def remove(self, name):
+        del self.machines[self.machine(name).id.lower()]
+
+    def call(self, operation, result, hooks=()):
+        with self._lock:
+            self.calls[operation] += 1
+            throttled = sum(self.calls.values()) <= self._throttle
+        if self._latency:
+            time.sleep(self._latency)
+        if throttled:
+            raise Throttled()
+        response = SimpleNamespace(
+            status_code=200, headers={"x-ms-ratelimit-remaining-subscription-reads": REMAINING_READS}, raw=None
+        )
+        for hook in hooks:
+            hook(response)
+        return result
+
+    def pages(self, operation, items, hooks=()):
+        return Pages(self, operation, list(items), hooks)
+
+    def get(self, operation, resources, subscription_id, resource_group, resource_type, name, hooks=()):
+        resource_id = "/subscriptions/%s/resourceGroups/%s/providers/%s/%s" % (
+            subscription_id, resource_group, resource_type, name
+        )
+        resource = resources.get(resource_id.lower())
+        self.call(operation, resource, hooks)
+        if resource is None:
+            raise NotFound("Resource %s not found" % name)
+        return resource
+
+    def in_scope(self, resources, subscription_id, resource_group=None):
+        return [
+            resource
+            for resource in resources
+            if resource.id.lower().split("/")[2] == subscription_id.lower()
+            and (resource_group is None or resource.id.lower().split("/")[4] == resource_group.lower())
+        ]
+
+    def client(self, subscription_id):
+        """ The clients of a subscription, whose responses go through the hooks registered in their config """
+        hooks = []
+        return SimpleNamespace(
+            config=SimpleNamespace(hooks=hooks),
+            virtual_machines=VirtualMachines(self, subscription_id, hooks),
+            network_interfaces=Operations(
+                self,
+                subscription_id,
+                hooks,
+                "network_interfaces",
+                "Microsoft.Network/networkInterfaces",
+                self.interfaces,
+            ),
+            public_ip_addresses=Operations(
+                self,
+                subscription_id,
+                hooks,
+                "public_ip_addresses",
+                "Microsoft.Network/publicIPAddresses",
+                self.addresses,
+            ),
+            network_security_groups=Operations(
+                self,
+                subscription_id,
+                hooks,
+                "network_security_groups",
+                "Microsoft.Network/networkSecurityGroups",
+                self.security_groups,
+            ),
+            resources=Resources(self, subscription_id, hooks),
+        )
+
+
+class SmallFleet(Fleet):
+    """ Three machines in each resource group of each subscription: a web host, a db host and a Windows one """
+
+    def __init__(self, throttle=0):
+        super(SmallFleet, self).__init__(throttle=throttle)
+        for subscription, subscription_id in enumerate(SUBSCRIPTION_IDS):
+            for group, resource_group in enumerate(RESOURCE_GROUPS):
+                providers = "/subscriptions/%s/resourceGroups/%s/providers/" % (subscription_id, resource_group.upper())
+                security_group = SimpleNamespace(
+                    id=providers + "Microsoft.Network/networkSecurityGroups/%s-nsg" % resource_group,
+                    name="%s-nsg" % resource_group,
+                    network_interfaces=[],
+                )
+                self.security_groups[security_group.id.lower()] = security_group
+                for index in range(3):
+                    self._add_machine(providers, subscription, group, index, security_group)
+
+    def _add_machine(self, providers, subscription, group, index, security_group):
+        number = subscription * 6 + group * 3 + index
+        name = ("web-%d" % number, "db.%d" % number, "win-%d" % number)[index]
+        interfaces = []
+        # Machines of the first resource group have a second network interface, listed first but not primary
+        for nic in range(2 if group == 0 else 1):
+            interface = self._add_interface(providers, name, number, nic, primary=nic == (1 if group == 0 else 0))
+            if interface.primary and index != 1:
+                security_group.network_interfaces.append(SimpleNamespace(id=interface.id))
+            interfaces.append(SimpleNamespace(id=interface.id))
+
+        windows_configuration = None
+        if index == 2:
+            windows_configuration = SimpleNamespace(
+                enable_automatic_updates=True,
+                time_zone="UTC",
+                win_rm=SimpleNamespace(
+                    listeners=[
+                        SimpleNamespace(
+                            protocol=SimpleNamespace(name="Https"),
+                            certificate_url="https://vault.example/secrets/winrm",
+                        )
+                    ]
+                ),
+            )
+        tags = {"env": ("prod", "staging")[group], "cost center": "R&D %d" % subscription}
+        if index == 0:
+            tags["role"] = "web"
+        machine = SimpleNamespace(
+            id=providers + "Microsoft.Compute/virtualMachines/%s" % name,
+            name=name,
+            type="Microsoft.Compute/virtualMachines",
+            location=("westeurope", "northeurope")[number % 2],
+            tags=tags if number != 5 else None,
+            plan=SimpleNamespace(name="windows-plan") if index == 2 else None,
+            hardware_profile=SimpleNamespace(vm_size="Standard_B2s"),
+            provisioning_state="Succeeded",
+            os_profile=SimpleNamespace(computer_name=name, windows_configuration=windows_configuration),
+            storage_profile=SimpleNamespace(
+                os_disk=SimpleNamespace(
+                    name="%s-disk" % name, os_type=SimpleNamespace(value="Windows" if index == 2 else "Linux")
+                ),
+                image_reference=SimpleNamespace(offer="debian-12", publisher="Debian", sku="12", version="latest"),
+            ),
+            network_profile=SimpleNamespace(network_interfaces=interfaces),
+            instance_view=SimpleNamespace(
+                statuses=[
+                    SimpleNamespace(code="ProvisioningState/succeeded"),
+                    SimpleNamespace(code="PowerState/deallocated" if number % 4 == 3 else "PowerState/running"),
+                ]
+            ),
+        )
+        self.machines[machine.id.lower()] = machine
+
+    def _add_interface(self, providers, name, number, nic, primary):
+        public_ip = None
+        if primary and number % 3 != 1:
+            public_ip = SimpleNamespace(
+                id=providers + "Microsoft.Network/publicIPAddresses/%s-ip" % name,
+                name="%s-ip" % name,
+                ip_address="20.0.0.%d" % number,
+                public_ip_allocation_method="Static",
+                dns_settings=SimpleNamespace(fqdn="%s.westeurope.cloudapp.azure.com" % name) if number % 2 else None,
+            )
+            self.addresses[public_ip.id.lower()] = public_ip
+        interface = SimpleNamespace(
+            id=providers + "Microsoft.Network/networkInterfaces/%s-nic-%d" % (name, nic),
+            name="%s-nic-%d" % (name, nic),
+            primary=primary,
+            mac_address="00-0D-3A-00-%02X-%02X" % (number, nic),
+            ip_configurations=[
+                SimpleNamespace(
+                    private_ip_address="10.%d.0.%d" % (nic, number),
+                    private_ip_allocation_method="Dynamic",
+                    public_ip_address=SimpleNamespace(id=public_ip.id) if public_ip else None,
+                )
+            ],
+        )
+        self.interfaces[interface.id.lower()] = interface
+        return interface
+
+
+class Pages(object):
+    """ A pager, which makes one call per page of the fleet page size, and one for an empty listing. As with the SDK,
+        a page whose call failed is fetched again by the next iteration. """
+
+    def __init__(self, fleet, operation, items, hooks):
+        self._fleet = fleet
+        self._operation = operation
+        self._items = items
+        self._hooks = hooks
+        self._page = []
+        self._next_page = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self._page:
+            if self._next_page >= len(self._items) and self._next_page:
+                raise StopIteration
+            page_size = self._fleet.page_size
+            page = self._items[self._next_page : self._next_page + page_size]
+            self._page = list(self._fleet.call(self._operation, page, self._hooks))
+            self._next_page += page_size
+        return self._page.pop(0)
+
+
+class Operations(object):
+    def __init__(self, fleet, subscription_id, hooks, name, resource_type, resources):
+        self._fleet = fleet
+        self._subscription_id = subscription_id
+        self._hooks = hooks
+        self._name = name
+        self._resource_type = resource_type
+        self._resources = resources
+
+    def list_all(self):
+        return self._fleet.pages(
+            self._name + ".list_all", self._fleet.in_scope(self._resources.values(), self._subscription_id), self._hooks
+        )
+
+    def list(self, resource_group):
+        return self._fleet.pages(
+            self._name + ".list",
+            self._fleet.in_scope(self._resources.values(), self._subscription_id, resource_group),
+            self._hooks,
+        )
+
+    def get(self, resource_group, name):
+        return self._fleet.get(
+            self._name + ".get",
+            self._resources,
+            self._subscription_id,
+            resource_group,
+            self._resource_type,
+            name,
+            self._hooks,
+        )
+
+
+class VirtualMachines(object):
+    def __init__(self, fleet, subscription_id, hooks):
+        self._fleet = fleet
+        self._subscription_id = subscription_id
+        self._hooks = hooks
+
+    def list_all(self, status_only=None):
+        operation = "virtual_machines.list_all(status_only)" if status_only else "virtual_machines.list_all"
+        return self._fleet.pages(
+            operation, self._fleet.in_scope(self._fleet.machines.values(), self._subscription_id), self._hooks
+        )
+
+    def list(self, resource_group):
+        return self._fleet.pages(
+            "virtual_machines.list",
+            self._fleet.in_scope(self._fleet.machines.values(), self._subscription_id, resource_group),
+            self._hooks,
+        )
+
+    def get(self, resource_group, name, expand=None):
+        operation = "virtual_machines.instance_view" if expand == "instanceview" else "virtual_machines.get"
+        return self._fleet.get(
+            operation,
+            self._fleet.machines,
+            self._subscription_id,
+            resource_group,
+            "Microsoft.Compute/virtualMachines",
+            name,
+            self._hooks,
+        )
+
+
+class Resources(object):
+    def __init__(self, fleet, subscription_id, hooks):
+        self._fleet = fleet
+        self._subscription_id = subscription_id
+        self._hooks = hooks
+
+    def list(self, filter=None):
+        name = re.search(r"name eq '([^']*)'", filter).group(1)
+        machines = self._fleet.in_scope(self._fleet.machines.values(), self._subscription_id)
+        return self._fleet.call(
+            "resources.list",
+            [SimpleNamespace(id=machine.id) for machine in machines if machine.name == name],
+            self._hooks,
+        )
+
+
+def fake_azure_rm(azure_rm, fleet):
+    """ An AzureRM class whose clients answer from fleet, through the same throttle and profiler as the real ones """
+
+    class FakeAzureRM(object):
+        def __init__(self, args, profiler=None, throttle=None, subscription_id=None):
+            self._args = args
+            self._profiler = profiler
+            self._throttle = throttle
+            # Every subscription when none is set, as found with MSI or Azure CLI credentials
+            subscription_ids = args.subscription_id or os.environ.get("AZURE_SUBSCRIPTION_ID") or ",".join(
+                fleet.subscription_ids
+            )
+            self.subscription_ids = [subscription.strip() for subscription in subscription_ids.split(",")]
+            self.subscription_id = subscription_id or self.subscription_ids[0]
+            client = fleet.client(self.subscription_id)
+            # A client of its own, like the newer API version the real status client is built with
+            status_client = fleet.client(self.subscription_id)
+            if throttle is not None:
+                client = azure_rm.ThrottledClient(client, throttle, profiler)
+                status_client = azure_rm.ThrottledClient(status_client, throttle, profiler)
+            self.compute_client = client
+            self.compute_status_client = status_client
+            self.network_client = client
+            self.rm_client = client
+
+        def for_subscription(self, subscription_id):
+            return FakeAzureRM(self._args, self._profiler, self._throttle, subscription_id)
+
+        def log(self, msg):
+            pass
+
+    return FakeAzureRM
+
+
+def main():
+    parser = argparse.ArgumentParser(usage="%(prog)s [options] -- azure_rm.py arguments")
+    parser.add_argument("--azure-rm", default="/etc/ansible/hosts-template/azure_rm.py")
+    parser.add_argument("--calls", help="JSON file the API calls made by operation are written to")
+    parser.add_argument("--change", action="append", default=[], help="Name of a machine whose state changed")
+    parser.add_argument("--remove", action="append", default=[], help="Name of a machine which was deleted")
+    parser.add_argument("--stop", action="append", default=[], help="Name of a machine which was deallocated")
+    parser.add_argument("--throttle", type=int, default=0, help="Number of first calls answered with HTTP 429")
+    parser.add_argument("azure_rm_args", nargs="*")
+    args = parser.parse_args()
+
+    fleet = SmallFleet(args.throttle)
+    for name in args.change:
+        fleet.change(name)
+    for name in args.remove:
+        fleet.remove(name)
+    for name in args.stop:
+        fleet.stop(name)
+
+    spec = importlib.util.spec_from_file_location("azure_rm", args.azure_rm)
+    azure_rm = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(azure_rm)
+    azure_rm.AzureRM = fake_azure_rm(azure_rm, fleet)
+    azure_rm.load_azure_sdk = lambda: True
+
+    sys.argv = [args.azure_rm] + args.azure_rm_args
+    try:
+        azure_rm.main()
+    finally:
+        if args.calls:
+            with open(args.calls, "w") as f:
+                json.dump(dict(fleet.calls), f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
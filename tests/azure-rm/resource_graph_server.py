@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Local stand-in for the Azure endpoints used by azure_rm.py with the resource_graph backend:
+# cloud metadata discovery, ADFS token and Resource Graph queries.
+#
+# Resource Graph answers are the rows of resources.json, two per page to exercise the paging,
+# and every query body received is appended to the log file as one JSON line.
+#
+# The server forks in the background once it listens, so that the caller can start using it right away:
+#   resource_graph_server.py --port 8443 --cert server.pem --log queries.log
+
+import argparse
+import json
+import os
+import ssl
+import sys
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+PAGE_SIZE = 2
+
+
+class Handler(BaseHTTPRequestHandler):
+    def _reply(self, body, status=200):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_GET(self):
+        if self.path.startswith("/metadata/endpoints"):
+            base = self.server.base_url
+            return self._reply(
+                {
+                    "galleryEndpoint": base,
+                    "graphEndpoint": base,
+                    "portalEndpoint": base,
+                    "authentication": {
+                        "loginEndpoint": base + "adfs",
+                        "audiences": [base],
+                    },
+                }
+            )
+        self._reply({"error": {"code": "NotFound", "message": self.path}}, 404)
+
+    def do_POST(self):
+        body = self._read_body()
+        if self.path.startswith("/adfs/oauth2/token"):
+            return self._reply(
+                {
+                    "token_type": "Bearer",
+                    "access_token": "stand-in-token",
+                    "expires_in": 3600,
+                    "resource": self.server.base_url,
+                }
+            )
+        if self.path.startswith("/providers/Microsoft.ResourceGraph/resources"):
+            if self.headers.get("Authorization") != "Bearer stand-in-token":
+                return self._reply({"error": {"code": "AuthenticationFailed"}}, 401)
+            query = json.loads(body.decode("utf-8"))
+            with open(self.server.log, "a") as f:
+                f.write(json.dumps(query) + "\n")
+            start = int(query.get("options", {}).get("$skipToken") or 0)
+            rows = self.server.rows[start : start + PAGE_SIZE]
+            result = {"totalRecords": len(self.server.rows), "count": len(rows), "data": rows}
+            if start + PAGE_SIZE < len(self.server.rows):
+                result["$skipToken"] = str(start + PAGE_SIZE)
+            return self._reply(result)
+        self._reply({"error": {"code": "NotFound", "message": self.path}}, 404)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8443)
+    parser.add_argument("--cert", help="PEM file holding the certificate and its key, serve plain HTTP without")
+    parser.add_argument("--log", default="queries.log")
+    parser.add_argument(
+        "--resources", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources.json")
+    )
+    parser.add_argument("--foreground", action="store_true")
+    args = parser.parse_args()
+
+    server = HTTPServer(("127.0.0.1", args.port), Handler)
+    scheme = "http"
+    if args.cert:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(args.cert)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        scheme = "https"
+    server.base_url = "%s://localhost:%d/" % (scheme, server.server_address[1])
+    server.log = os.path.abspath(args.log)
+    with open(args.resources) as f:
+        server.rows = json.load(f)
+
+    print(server.base_url)
+    sys.stdout.flush()
+    if not args.foreground:
+        if os.fork():
+            return
+        # Detach from the caller's terminal so that it does not wait for the server
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()